@@ -20,13 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import time
+from datetime import datetime
+
 import click
 from flask import Flask
 from flask_bootstrap import Bootstrap
 
+from .audit import backfill_logs
 from .auth import login_manager, add_user
+from .caching import page_cache
+from .edge import edge
 from .endpoints import api
+from .importer import DUPLICATE_POLICIES, FORMATS, import_keys
+from .keymanager import (BULK_ACTIONS, bulk_update_keys, count_expired_keys,
+                         count_keys, expire_keys, next_expiry)
+from .migrations import current_version, head_version, stamp, upgrade
 from .models import db, Event
+from .plancheck import check_plans
+from .pool import pools
+from .profiling import init_profiling
+from .sharding import rebalance_app, shards
+from .snapshot import build_snapshot
+from .stream import audit_stream
 from .views import frontend
 
 
@@ -48,26 +64,178 @@ def create_app(config):
     app = Flask(__name__)
 
     app.config.from_object(__name__)
-    app.config.from_object("keyserv.config.{}".format(config))
+    if isinstance(config, str):
+        config = "keyserv.config.{}".format(config)
+    app.config.from_object(config)
     app.jinja_env.filters["event"] = format_event
     app.jinja_env.filters["datetime"] = format_datetime
 
     Bootstrap(app)
     api.init_app(app)
+    shards.init_app(app)
+    pools.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
+    page_cache.init_app(app)
+    audit_stream.init_app(app)
+    edge.init_app(app)
 
     app.register_blueprint(frontend)
 
+    if app.config.get("PROFILE_ENABLED"):
+        init_profiling(app)
+
     @app.cli.command("initdb")
     def initdb_command():
         db.create_all()
+        stamp()
+        shards.create_tables()
+        for name in shards.names()[1:]:
+            stamp(shards.engine(name))
         print("database initialized")
 
+    @app.cli.command("upgradedb")
+    @click.option("--offline", is_flag=True,
+                  help="build indexes without CONCURRENTLY on PostgreSQL")
+    def upgradedb_command(offline: bool):
+        for name in shards.names():
+            engine = shards.engine(name)
+            applied = upgrade(online=not offline, engine=engine)
+            print(f"{name}: applied {applied} migration(s), schema version "
+                  f"{current_version(engine)} of {head_version()}")
+        shards.create_tables()
+
+    @app.cli.command("check-plans")
+    @click.option("--seed", default=10000, show_default=True,
+                  help="keys to add (and roll back) before explaining")
+    def check_plans_command(seed: int):
+        ok = True
+        for name in shards.each():
+            print(f"shard {name}")
+            ok = check_plans(seed) and ok
+        if not ok:
+            raise SystemExit("a hot query plan reads a whole table")
+
     @app.cli.command("create-user")
     @click.argument("username")
     @click.argument("password")
     def create_user_command(username: str, password: str):
         add_user(username, password.encode())
 
+    @app.cli.command("backfill-logs")
+    @click.option("--batch-size", default=1000, show_default=True)
+    def backfill_logs_command(batch_size: int):
+        updated = backfill_logs(batch_size, lambda count: print(
+            f"updated {count} log(s)"))
+        print(f"backfilled {updated} audit log(s)")
+
+    @app.cli.command("bulk-keys")
+    @click.argument("action", type=click.Choice(BULK_ACTIONS))
+    @click.option("--value", help="activations or application id")
+    @click.option("--app-id", type=int, help="only keys for this app")
+    @click.option("--enabled/--disabled", default=None,
+                  help="only active or inactive keys")
+    @click.option("--memo", help="only keys with a memo containing this")
+    @click.option("--tokens-file", type=click.File(),
+                  help="only the tokens listed in this file, one per line")
+    @click.option("--all", "all_keys", is_flag=True,
+                  help="change every key when no filter is given")
+    @click.option("--chunk-size", default=1000, show_default=True)
+    def bulk_keys_command(action: str, value, app_id, enabled, memo,
+                          tokens_file, all_keys: bool, chunk_size: int):
+        total = None
+        if tokens_file is None:
+            total = count_keys(app_id, enabled, memo)
+
+        with click.progressbar(length=total, label=f"bulk {action}") as bar:
+            try:
+                updated = bulk_update_keys(action, value, app_id, enabled,
+                                           memo, tokens_file, actor="cli",
+                                           chunk_size=chunk_size,
+                                           progress=bar.update,
+                                           all_keys=all_keys)
+            except ValueError as error:
+                raise click.ClickException(str(error))
+        print(f"updated {updated} key(s)")
+
+    @app.cli.command("expire-keys")
+    @click.option("--chunk-size", default=1000, show_default=True)
+    @click.option("--watch", is_flag=True,
+                  help="keep running, sweeping again when the next key is due")
+    @click.option("--max-sleep", default=300, show_default=True,
+                  help="longest wait between sweeps with --watch, so keys "
+                       "given an earlier expiry meanwhile are not missed")
+    def expire_keys_command(chunk_size: int, watch: bool, max_sleep: int):
+        while True:
+            due = count_expired_keys()
+            if due or not watch:
+                with click.progressbar(length=due, label="expiring") as bar:
+                    expired = expire_keys(chunk_size=chunk_size,
+                                          progress=bar.update)
+                print(f"expired {expired} key(s)")
+            if not watch:
+                return
+
+            following = next_expiry()
+            wait = max_sleep
+            if following is not None:
+                wait = min(max_sleep, max(
+                    1, (following - datetime.utcnow()).total_seconds()))
+            db.session.remove()
+            time.sleep(wait)
+
+    @app.cli.command("build-snapshot")
+    @click.argument("path")
+    def build_snapshot_command(path: str):
+        watermark = build_snapshot(path)
+        print(f"snapshot written to {path}, current as of {watermark} UTC")
+
+    @app.cli.command("edge-refresh")
+    @click.option("--full", is_flag=True,
+                  help="download a whole snapshot instead of a delta")
+    def edge_refresh_command(full: bool):
+        if not edge.enabled:
+            raise SystemExit("EDGE_PRIMARY_URL is not set")
+        edge.node.refresh(full)
+        print(f"snapshot current as of {edge.node.snapshot.watermark} UTC")
+
+    @app.cli.command("import-keys")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--format", "fmt", type=click.Choice(FORMATS),
+                  help="defaults to the file extension")
+    @click.option("--app-id", type=int,
+                  help="application for rows without an app_id")
+    @click.option("--duplicates", type=click.Choice(DUPLICATE_POLICIES),
+                  default="skip", show_default=True)
+    @click.option("--batch-size", default=5000, show_default=True)
+    @click.option("--checkpoint",
+                  help="resume file, defaults to PATH.checkpoint")
+    @click.option("--skip-invalid", is_flag=True)
+    def import_keys_command(path: str, fmt, app_id, duplicates: str,
+                            batch_size: int, checkpoint, skip_invalid: bool):
+        if fmt is None:
+            fmt = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+        rows = 0
+
+        def progress(count: int):
+            nonlocal rows
+            rows += count
+            print(f"loaded {rows} row(s)")
+
+        with open(path, newline="", encoding="utf-8") as lines:
+            result = import_keys(lines, fmt, app_id, duplicates, batch_size,
+                                 checkpoint or path + ".checkpoint",
+                                 skip_invalid, "cli", progress)
+        if result.resumed_after:
+            print(f"resumed after line {result.resumed_after}")
+        print(f"import finished: {result}")
+
+    @app.cli.command("rebalance-app")
+    @click.argument("app_id", type=int)
+    @click.argument("shard")
+    @click.option("--batch-size", default=5000, show_default=True)
+    def rebalance_app_command(app_id: int, shard: str, batch_size: int):
+        rebalance_app(app_id, shard, batch_size)
+
     return app
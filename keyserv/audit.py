@@ -0,0 +1,191 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+from datetime import datetime
+
+from keyserv.models import AuditLog, db
+from keyserv.sharding import shards
+
+# matches the text produced by keymanager.Origin.__str__
+ORIGIN_RE = re.compile(r"IP: (?P<ip>.*?), Machine: (?P<machine>.*?), "
+                       r"User: (?P<user>.*)$")
+# matches "new key cut by ..." and "edited by ..." messages from the frontend
+ACTOR_RE = re.compile(r"(?:cut|edited) by (?P<actor>\S+) \((?P<ip>[^)]*)\)")
+
+
+def by_time(since: datetime = None, until: datetime = None) -> bool:
+    """Whether logs must be ordered by (timestamp, id) rather than id.
+    While sharded, ids are handed out to each worker in blocks, so they only
+    follow the order logs were written in on a single database."""
+    return shards.enabled or since is not None or until is not None
+
+
+def newest_first(by_time: bool) -> tuple:
+    """ORDER BY columns listing logs newest first."""
+    if by_time:
+        return AuditLog.timestamp.desc(), AuditLog.id.desc()
+    return AuditLog.id.desc(),
+
+
+def newest_first_key(by_time: bool):
+    """Sort key matching newest_first, for use with reverse=True."""
+    if by_time:
+        return lambda log: (log.timestamp, log.id)
+    return lambda log: log.id
+
+
+def search_logs(ip: str = None, machine: str = None, user: str = None,
+                hwid: str = None, actor: str = None, key_id: int = None,
+                app_id: int = None, event_type: int = None,
+                since: datetime = None, until: datetime = None,
+                before_id: int = None, limit: int = 100):
+    """
+    Build a query for audit logs matching all of the given filters, newest
+    first. Only the indexed origin and actor columns are searched; the free
+    form message is never scanned. Only the selected shard is searched, see
+    search_all_logs.
+
+    before_id: - only return logs older than this id, used to page results
+    """
+    query = AuditLog.query
+    ordered_by_time = by_time(since, until)
+
+    for column, value in ((AuditLog.origin_ip, ip),
+                          (AuditLog.origin_machine, machine),
+                          (AuditLog.origin_user, user),
+                          (AuditLog.origin_hwid, hwid),
+                          (AuditLog.actor, actor),
+                          (AuditLog.key_id, key_id),
+                          (AuditLog.app_id, app_id),
+                          (AuditLog.event_type, event_type)):
+        if value is not None:
+            query = query.filter(column == value)
+
+    if since is not None:
+        query = query.filter(AuditLog.timestamp >= since)
+    if until is not None:
+        query = query.filter(AuditLog.timestamp < until)
+    if before_id is not None:
+        before = None
+        if ordered_by_time:
+            before = shards.find(lambda: db.session.query(AuditLog.timestamp)
+                                 .filter_by(id=before_id).scalar())
+        if before is not None:
+            query = query.filter(
+                (AuditLog.timestamp < before) |
+                ((AuditLog.timestamp == before) & (AuditLog.id < before_id)))
+        else:
+            query = query.filter(AuditLog.id < before_id)
+
+    # ordering by time lets the timestamp index serve both a time range and
+    # the ordering
+    return query.order_by(*newest_first(ordered_by_time)).limit(limit)
+
+
+def search_all_logs(ip: str = None, machine: str = None, user: str = None,
+                    hwid: str = None, actor: str = None, key_id: int = None,
+                    app_id: int = None, event_type: int = None,
+                    since: datetime = None, until: datetime = None,
+                    before_id: int = None, limit: int = 100) -> list:
+    """Run search_logs on the shard of `app_id`, or on every shard merging
+    the results, and return the matching logs."""
+    query = search_logs(ip, machine, user, hwid, actor, key_id, app_id,
+                        event_type, since, until, before_id, limit)
+    if app_id is not None:
+        shards.select_app(app_id)
+        return query.all()
+
+    return list(shards.merge(lambda: query,
+                             key=newest_first_key(by_time(since, until)),
+                             reverse=True, limit=limit))
+
+
+def parse_message(message: str) -> dict:
+    """Extract the structured origin and actor fields embedded in a legacy
+    audit log message. Returns only the fields that could be found."""
+    fields = {}
+    if not message:
+        return fields
+
+    match = ORIGIN_RE.search(message)
+    if match:
+        fields["origin_ip"] = match.group("ip")
+        fields["origin_machine"] = match.group("machine")
+        fields["origin_user"] = match.group("user")
+
+    match = ACTOR_RE.search(message)
+    if match:
+        fields["actor"] = match.group("actor")
+        fields["origin_ip"] = match.group("ip")
+
+    return fields
+
+
+def backfill_logs(batch_size: int = 1000, progress=None) -> int:
+    """
+    Populate the structured columns of audit logs written before they
+    existed by parsing their messages. Works through each shard in id order,
+    `batch_size` rows per transaction, so it can be interrupted and re-run.
+
+    progress: - optional callable given the number of rows updated per batch
+
+    Returns the number of rows updated.
+    """
+    updated = 0
+    for _ in shards.each():
+        updated += _backfill_shard(batch_size, progress)
+    return updated
+
+
+def _backfill_shard(batch_size: int, progress) -> int:
+    updated = 0
+    last_id = 0
+
+    while True:
+        rows = (db.session.query(AuditLog.id, AuditLog.message)
+                .filter(AuditLog.id > last_id)
+                .filter(AuditLog.origin_ip.is_(None))
+                .filter(AuditLog.actor.is_(None))
+                .order_by(AuditLog.id)
+                .limit(batch_size)
+                .all())
+        if not rows:
+            break
+
+        last_id = rows[-1].id
+        mappings = []
+        for row in rows:
+            fields = parse_message(row.message)
+            if fields:
+                fields["id"] = row.id
+                mappings.append(fields)
+
+        if mappings:
+            db.session.bulk_update_mappings(AuditLog, mappings)
+        db.session.commit()
+
+        updated += len(mappings)
+        if progress:
+            progress(len(mappings))
+
+    return updated
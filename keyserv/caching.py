@@ -0,0 +1,107 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+
+class PageCache:
+    """Rendered admin pages, keyed by the ETag of the data they show and
+    evicted least recently used first."""
+
+    def __init__(self, size: int = 128):
+        self.size = size
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.size = app.config.get("PAGE_CACHE_SIZE", self.size)
+
+    def get(self, etag: str):
+        with self._lock:
+            html = self._pages.get(etag)
+            if html is not None:
+                self._pages.move_to_end(etag)
+            return html
+
+    def put(self, etag: str, html: str):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._pages[etag] = html
+            self._pages.move_to_end(etag)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+
+page_cache = PageCache()
+
+
+def _not_modified(etag: str, last_modified: datetime) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    return last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+
+
+def render_conditional(page: str, version: tuple, render):
+    """
+    Answer a GET for an admin page with ETag and Last-Modified validators.
+
+    version: - values that change whenever the page's data does, such as
+               the newest id and updated_at of the rows it lists. The newest
+               datetime among them is sent as Last-Modified.
+    render: - callable returning the page's HTML; only called when the
+              client's copy is stale and the page is not cached
+
+    Pages with pending flashed messages are always rendered.
+    """
+    if session.get("_flashes"):
+        return render()
+
+    digest = hashlib.sha1(repr((page, version, current_user.get_id()))
+                          .encode()).hexdigest()
+    etag = f"{page}-{digest}"
+    dates = [value for value in version if isinstance(value, datetime)]
+    last_modified = max(dates) if dates else None
+
+    if _not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        html = page_cache.get(etag)
+        if html is None:
+            html = render()
+            page_cache.put(etag, html)
+        response = current_app.response_class(html)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,89 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class ResultCache:
+    """
+    The last successful check of each key, persisted to a JSON file so a
+    client can keep working through a server outage or a restart while
+    offline. Tokens are stored hashed.
+
+    path: - file to persist to, or None to only cache in memory
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path and os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as cache:
+                    self._entries = json.load(cache)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    @staticmethod
+    def _key(app_id: int, token: str, hwid: str) -> str:
+        return hashlib.sha256(f"{app_id}\0{token}\0{hwid}".encode()) \
+            .hexdigest()
+
+    def get(self, app_id: int, token: str, hwid: str) -> float:
+        """Return when the key was last checked successfully, as a unix
+        timestamp, or None."""
+        with self._lock:
+            return self._entries.get(self._key(app_id, token, hwid))
+
+    def put(self, app_id: int, token: str, hwid: str):
+        self._update(self._key(app_id, token, hwid), time.time())
+
+    def discard(self, app_id: int, token: str, hwid: str):
+        self._update(self._key(app_id, token, hwid), None)
+
+    def _update(self, key: str, value):
+        with self._lock:
+            if value is None:
+                if self._entries.pop(key, None) is None:
+                    return
+            else:
+                self._entries[key] = value
+            if self.path:
+                self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w") as cache:
+                json.dump(self._entries, cache)
+            os.replace(temp, self.path)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
@@ -0,0 +1,302 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import getpass
+import platform
+import random
+import time
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from keyserv.client.cache import ResultCache
+
+# responses worth retrying idempotent requests on
+RETRY_STATUSES = (429, 502, 503, 504)
+# responses that mean the server did not handle the request, so that even
+# non idempotent requests can be sent again. a gateway error may arrive
+# after the server handled the request
+UNHANDLED_STATUSES = (429, 503)
+
+
+class KeyServerError(Exception):
+    """Raised when the key server rejects a request."""
+    pass
+
+
+class ActivationFailed(KeyServerError):
+    """Raised when a key cannot be activated."""
+
+    def __init__(self, error: str, support_message: str = None,
+                 status: int = None):
+        super().__init__(error)
+        self.support_message = support_message
+        self.status = status
+
+
+class Unavailable(KeyServerError):
+    """Raised when the key server cannot be reached after retrying, and no
+    cached result can stand in."""
+    pass
+
+
+def _never_sent(error: requests.ConnectionError) -> bool:
+    """Whether a connection error happened before the request could have
+    reached the server."""
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or \
+        isinstance(reason, NewConnectionError)
+
+
+def _error(response: requests.Response) -> str:
+    """The error message of a failed response."""
+    try:
+        error = response.json().get("error")
+    except ValueError:
+        error = None
+    return error or f"server responded {response.status_code}"
+
+
+class CheckResult:
+    """Outcome of a key check. `offline` is set when the server could not
+    be reached and the result comes from the local cache."""
+
+    def __init__(self, token: str, valid: bool, offline: bool = False,
+                 checked_at: float = None):
+        self.token = token
+        self.valid = valid
+        self.offline = offline
+        self.checked_at = checked_at
+
+    def __bool__(self):
+        return self.valid
+
+    def __repr__(self):
+        return (f"<CheckResult({self.token}, valid={self.valid}, "
+                f"offline={self.offline})>")
+
+
+class KeyServerClient:
+    """
+    Client for one application's keys on a key server.
+
+    Requests share a keep-alive connection pool. Connection failures, 429s
+    and 502-504s are retried with jittered exponential backoff, waiting at
+    least as long as a Retry-After header asks. Successful checks are cached
+    in `cache_path`; while the server is unreachable a key that was last
+    seen valid less than `grace_period` ago is still reported valid.
+
+    base_url: - root of the key server, e.g. https://keys.example.com
+    machine, user: - identify this client in the audit log; default to the
+                     host name and logged in user
+    hwid: - hardware id this client activates and checks keys with
+    cache_ttl: - seconds a successful check is reused without asking the
+                 server again; 0 always asks
+    """
+
+    def __init__(self, base_url: str, app_id: int, hwid: str,
+                 machine: str = None, user: str = None,
+                 cache_path: str = None,
+                 grace_period: timedelta = timedelta(days=7),
+                 cache_ttl: float = 0, timeout: float = 10,
+                 max_retries: int = 5, backoff: float = 0.5,
+                 max_backoff: float = 60, pool_size: int = 4,
+                 batch_size: int = 100):
+        self.base_url = base_url.rstrip("/")
+        self.app_id = app_id
+        self.hwid = hwid
+        self.machine = machine or platform.node()
+        self.user = user or getpass.getuser()
+        self.cache = ResultCache(cache_path)
+        self.grace_period = grace_period.total_seconds()
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _delay(self, attempt: int, response=None) -> float:
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        retry_after = response is not None and \
+            response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    wait = parsedate_to_datetime(retry_after).timestamp() \
+                        - time.time()
+                except (TypeError, ValueError):
+                    wait = 0
+            delay = max(delay, min(wait, self.max_backoff))
+        return delay
+
+    def _request(self, method: str, path: str, idempotent: bool = True,
+                 **kwargs) -> requests.Response:
+        """
+        Send a request, retrying while the server is unreachable or asks us
+        to back off. Non idempotent requests are only retried when the
+        server cannot have handled them. Raises Unavailable.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.request(
+                    method, self.base_url + path, timeout=self.timeout,
+                    **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = f"server responded {response.status_code}"
+                if not idempotent and \
+                        response.status_code not in UNHANDLED_STATUSES:
+                    raise Unavailable(error)
+            except requests.ConnectionError as exc:
+                if not idempotent and not _never_sent(exc):
+                    raise Unavailable(str(exc))
+                error = str(exc)
+            except requests.Timeout as exc:
+                if not idempotent:
+                    raise Unavailable(str(exc))
+                error = str(exc)
+
+            if attempt < self.max_retries:
+                time.sleep(self._delay(attempt, response))
+
+        raise Unavailable(f"{method} {path} failed after "
+                          f"{self.max_retries + 1} attempt(s): {error}")
+
+    def _fresh(self, token: str) -> CheckResult:
+        checked_at = self.cache.get(self.app_id, token, self.hwid)
+        if checked_at and time.time() - checked_at < self.cache_ttl:
+            return CheckResult(token, True, checked_at=checked_at)
+        return None
+
+    def _offline(self, token: str, error: Unavailable) -> CheckResult:
+        checked_at = self.cache.get(self.app_id, token, self.hwid)
+        if checked_at and time.time() - checked_at < self.grace_period:
+            return CheckResult(token, True, True, checked_at)
+        raise error
+
+    def _record(self, token: str, valid: bool) -> CheckResult:
+        if valid:
+            self.cache.put(self.app_id, token, self.hwid)
+        else:
+            self.cache.discard(self.app_id, token, self.hwid)
+        return CheckResult(token, valid, checked_at=time.time())
+
+    def check(self, token: str) -> CheckResult:
+        """Check whether `token` is valid for this application and hwid.
+        Raises Unavailable if the server cannot be reached and the key has
+        not been seen valid within the grace period."""
+        fresh = self._fresh(token)
+        if fresh:
+            return fresh
+
+        try:
+            response = self._request("GET", "/api/check", params={
+                "token": token, "app_id": self.app_id, "hwid": self.hwid,
+                "machine": self.machine, "user": self.user})
+        except Unavailable as error:
+            return self._offline(token, error)
+
+        if response.status_code >= 500:
+            return self._offline(token, Unavailable(
+                f"server responded {response.status_code}"))
+        return self._record(token, response.status_code == 201)
+
+    def check_many(self, tokens: list) -> list:
+        """Check several tokens, sending up to `batch_size` of them per
+        request. Returns a CheckResult per token, in order. Raises
+        KeyServerError if the server rejects a batch, e.g. when `batch_size`
+        is above its CHECK_BATCH_LIMIT."""
+        results = {}
+        pending = []
+        for token in tokens:
+            fresh = self._fresh(token)
+            if fresh:
+                results[token] = fresh
+            elif token not in pending:
+                pending.append(token)
+
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            try:
+                response = self._request("POST", "/api/check/batch", json={
+                    "app_id": self.app_id, "checks": [{
+                        "token": token, "hwid": self.hwid,
+                        "machine": self.machine, "user": self.user}
+                        for token in batch]})
+                if 400 <= response.status_code < 500:
+                    raise KeyServerError(_error(response))
+                if response.status_code != 200:
+                    raise Unavailable(
+                        f"server responded {response.status_code}")
+            except Unavailable as error:
+                for token in batch:
+                    results[token] = self._offline(token, error)
+                continue
+
+            for result in response.json()["results"]:
+                results[result["token"]] = self._record(
+                    result["token"], result["result"] == "ok")
+
+        return [results[token] for token in tokens]
+
+    def activate(self, token: str) -> int:
+        """
+        Activate `token` for this hwid and return the remaining activations
+        (-1 for unlimited). Raises ActivationFailed if the key is invalid or
+        out of activations, and Unavailable if the server cannot be reached.
+        """
+        response = self._request("POST", "/api/activate", idempotent=False,
+                                 data={"token": token, "app_id": self.app_id,
+                                       "hwid": self.hwid,
+                                       "machine": self.machine,
+                                       "user": self.user})
+        body = response.json()
+        if response.status_code != 201:
+            raise ActivationFailed(body.get("error", "activation failed"),
+                                   body.get("support_message"),
+                                   response.status_code)
+
+        self.cache.put(self.app_id, token, self.hwid)
+        return int(body["remainingActivations"])
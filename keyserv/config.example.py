@@ -12,11 +12,101 @@ class DefaultConfig(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
 
+    # how each audit event type is stored: "full" (a row per event),
+    # "aggregate" (one row per key, origin and interval with a count),
+    # "sample" (a fraction of events) or "none". unlisted types are "full".
+    AUDIT_POLICY = {"KeyAccess": "aggregate"}
+    AUDIT_AGGREGATE_INTERVAL = 3600  # seconds
+    AUDIT_SAMPLE_RATE = 0.01
+
+    # keys updated per transaction by bulk operations
+    BULK_CHUNK_SIZE = 1000
+    # rows loaded per transaction by key imports from the frontend
+    IMPORT_BATCH_SIZE = 5000
+
+    # rendered admin pages kept per worker to answer unchanged refreshes
+    PAGE_CACHE_SIZE = 128
+
+    # most checks accepted by one /api/check/batch request
+    CHECK_BATCH_LIMIT = 100
+
+    # live audit stream of the log page. "local" only streams the logs
+    # written by the same worker; "postgres" uses LISTEN/NOTIFY so every
+    # worker sees every log
+    AUDIT_STREAM_BACKEND = "local"
+    AUDIT_STREAM_CHANNEL = "keyserv_audit"
+    AUDIT_STREAM_QUEUE = 1000  # events buffered per client before dropping
+    AUDIT_STREAM_KEEPALIVE = 15  # seconds
+
+    # snapshots of the keys for edge nodes. edges authenticate with
+    # SNAPSHOT_TOKEN; the snapshot endpoints are disabled while it is None.
+    # full snapshots are cached at SNAPSHOT_PATH for SNAPSHOT_MAX_AGE
+    # seconds, and edges that fall more than SNAPSHOT_DELTA_LIMIT changed
+    # keys behind download a full one again.
+    SNAPSHOT_TOKEN = None
+    SNAPSHOT_PATH = "snapshot.sqlite"
+    SNAPSHOT_MAX_AGE = 3600
+    SNAPSHOT_DELTA_LIMIT = 50000
+    SNAPSHOT_OVERLAP = 60  # seconds re-read before each delta's watermark
+
+    # extra databases holding the keys and audit logs of some applications,
+    # by name. SHARD_MAP assigns application ids to them; other applications
+    # stay in the main database, the "default" shard. assignments made by
+    # flask rebalance-app are picked up within SHARD_MAP_TTL seconds.
+    SHARDS = {}  # e.g. {"eu": "postgres://eu-db/keyserver"}
+    SHARD_MAP = {}  # e.g. {3: "eu"}
+    SHARD_MAP_TTL = 5
+    # key and audit log ids each worker reserves at a time while sharded
+    SHARD_ID_BLOCK = 1000
+
+    # per request profiling. requests are profiled at PROFILE_SAMPLE_RATE, or
+    # when they carry PROFILE_HEADER from a logged in user or set to
+    # PROFILE_TOKEN. PROFILE_MODE is "cprofile" (writes .pstats files) or
+    # "sample" (writes .folded collapsed stacks for flame graphs).
+    PROFILE_ENABLED = False
+    PROFILE_MODE = "cprofile"
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_HEADER = "X-Keyserv-Profile"
+    PROFILE_TOKEN = None
+    PROFILE_INTERVAL = 0.005  # seconds between samples in "sample" mode
+    PROFILE_DIR = "profiles"
+    PROFILE_MAX_FILES = 500
+
 
 class ProductionConfig(DefaultConfig):
 
     SQLALCHEMY_DATABASE_URI = "postgres://localhost/keyserver"
 
+    # connection pool of each worker, per database (shards included).
+    # workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below the
+    # server's max_connections
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 10  # seconds a request waits for a free connection
+    DB_POOL_RECYCLE = 1800  # seconds before a connection is replaced
+    DB_POOL_PRE_PING = True  # test connections before handing them out
+    DB_POOL_PREWARM = 2  # connections each worker opens when it starts
+    DB_CONNECT_TIMEOUT = 5  # seconds
+
+    # statement timeouts of requests in milliseconds, None for no limit. the
+    # API one applies to /api/activate, /api/check and /api/check/batch. CLI
+    # commands are never limited
+    DB_STATEMENT_TIMEOUT = None
+    DB_API_STATEMENT_TIMEOUT = 2000
+
+    # set when connecting through PgBouncer in transaction pooling mode,
+    # which the postgres audit stream backend cannot use
+    DB_PGBOUNCER = False
+
+
+class EdgeConfig(DefaultConfig):
+    # check-only node answering from a snapshot of the primary's keys.
+    # SNAPSHOT_TOKEN must match the primary's
+    EDGE_PRIMARY_URL = "http://localhost:5000"
+    EDGE_SNAPSHOT_PATH = "edge-snapshot.sqlite"
+    EDGE_REFRESH_INTERVAL = 30  # seconds
+    EDGE_TIMEOUT = 10  # seconds
+
 
 class DevelopmentConfig(ProductionConfig):
     DEBUG = True
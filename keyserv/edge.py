@@ -0,0 +1,206 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+from datetime import datetime
+
+import requests
+from flask import abort, current_app, request
+
+from keyserv.snapshot import Snapshot, format_time
+
+# API endpoints an edge node serves; everything else lives on the primary
+EDGE_ENDPOINTS = ("activatekey", "checkkey", "checkkeys")
+
+
+class EdgeNode:
+    """
+    Check-only mode for key servers far from the primary database.
+
+    The server answers /api/check and /api/check/batch from a local snapshot
+    of the keys, refreshed from the primary every EDGE_REFRESH_INTERVAL
+    seconds, and forwards activations to the primary. Checks are counted
+    locally and reported to the primary with each refresh, so key
+    statistics and audit logs stay complete.
+    """
+
+    def __init__(self, app):
+        self._reports = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self.primary = app.config["EDGE_PRIMARY_URL"].rstrip("/")
+        self.snapshot = Snapshot(app.config.get("EDGE_SNAPSHOT_PATH",
+                                                "edge-snapshot.sqlite"))
+        self.interval = app.config.get("EDGE_REFRESH_INTERVAL", 30)
+        self.timeout = app.config.get("EDGE_TIMEOUT", 10)
+        self.logger = app.logger
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = \
+            f"Bearer {app.config.get('SNAPSHOT_TOKEN')}"
+
+    def _before_request(self):
+        if request.endpoint not in EDGE_ENDPOINTS:
+            abort(404)
+
+        if not self.snapshot.exists:
+            try:
+                self.refresh(only_if_missing=True)
+            except requests.RequestException as error:
+                self.logger.error(f"cannot fetch a snapshot: {error}")
+                abort(503)
+
+        with self._lock:
+            if self._thread is None:
+                # started on the first request so it runs in each worker
+                # rather than in a parent process that forks them
+                self._thread = threading.Thread(target=self._refresh_forever,
+                                                daemon=True,
+                                                name="edge-refresh")
+                self._thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("snapshot refresh failed")
+
+    def refresh(self, full: bool = False, only_if_missing: bool = False):
+        """Report counted checks, then bring the snapshot up to date with a
+        delta from the primary, or a full snapshot if there is none yet or
+        the delta is too large. One refresh runs at a time; with
+        `only_if_missing` nothing is done if another one created the
+        snapshot meanwhile."""
+        with self._refresh_lock:
+            if only_if_missing and self.snapshot.exists:
+                return
+            self._refresh(full)
+
+    def _refresh(self, full: bool):
+        self.send_reports()
+
+        if not full and self.snapshot.exists:
+            response = self.session.get(
+                f"{self.primary}/api/snapshot", timeout=self.timeout,
+                params={"since": format_time(self.snapshot.watermark)})
+            if response.status_code != 409:
+                response.raise_for_status()
+                self.snapshot.apply(response.json())
+                return
+
+        response = self.session.get(f"{self.primary}/api/snapshot/full",
+                                    timeout=self.timeout, stream=True)
+        response.raise_for_status()
+        self.snapshot.replace(response.iter_content(1 << 16))
+
+    def check(self, app_id: int, checks: list) -> list:
+        """Validate (token, keymanager.Origin) pairs against the snapshot
+        and count the valid ones for the primary."""
+        found = self.snapshot.keys_valid(
+            app_id, [(token, origin.hwid) for token, origin in checks])
+        now = format_time(datetime.utcnow())
+
+        with self._lock:
+            for key_id, (_, origin) in zip(found, checks):
+                if key_id is None:
+                    continue
+                report = self._reports.setdefault(
+                    (app_id, key_id, origin.ip, origin.machine, origin.user,
+                     origin.hwid), {"count": 0})
+                report["count"] += 1
+                report["last_check_ts"] = now
+        return [key_id is not None for key_id in found]
+
+    def send_reports(self):
+        """Send the checks counted since the last report to the primary."""
+        with self._lock:
+            reports, self._reports = self._reports, {}
+        if not reports:
+            return
+
+        checks = [dict(zip(("app_id", "key_id", "ip", "machine", "user",
+                            "hwid"), key), **report)
+                  for key, report in reports.items()]
+        try:
+            self.session.post(f"{self.primary}/api/snapshot/checks",
+                              json={"checks": checks},
+                              timeout=self.timeout).raise_for_status()
+        except requests.RequestException:
+            # count them again with the next report
+            with self._lock:
+                for key, report in reports.items():
+                    merged = self._reports.setdefault(key, {"count": 0})
+                    merged["count"] += report["count"]
+                    merged.setdefault("last_check_ts",
+                                      report["last_check_ts"])
+            raise
+
+    def activate(self, args: dict) -> tuple:
+        """Forward an activation to the primary and return its response and
+        status. The client's address is sent along in origin_ip, which the
+        primary only accepts with the snapshot token."""
+        try:
+            response = self.session.post(
+                f"{self.primary}/api/activate",
+                data=dict(args, origin_ip=request.remote_addr),
+                timeout=self.timeout)
+            result = response.json()
+        except (requests.RequestException, ValueError) as error:
+            self.logger.error(f"activation not forwarded: {error}")
+            return {"result": "failure", "error": "key server unavailable",
+                    "support_message": None}, 503
+
+        if response.status_code == 201:
+            self.snapshot.record_activation(
+                args["app_id"], args["token"], args["hwid"],
+                int(result["remainingActivations"]))
+        return result, response.status_code
+
+
+class Edge:
+    """
+    Extension that turns an app into an edge node when EDGE_PRIMARY_URL is
+    set. The node lives in the app's extensions, so a primary and an edge
+    can run in one process, e.g. under test.
+    """
+
+    def init_app(self, app):
+        node = None
+        if app.config.get("EDGE_PRIMARY_URL"):
+            node = EdgeNode(app)
+            app.before_request(node._before_request)
+        app.extensions["edge"] = node
+
+    @property
+    def node(self) -> EdgeNode:
+        """The current app's edge node, None unless it is an edge."""
+        return current_app.extensions.get("edge")
+
+    @property
+    def enabled(self) -> bool:
+        return self.node is not None
+
+
+edge = Edge()
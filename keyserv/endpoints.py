@@ -21,12 +21,22 @@
 # SOFTWARE.
 
 
-from flask import request
-from flask_restful import Api, Resource, reqparse
+from flask import current_app, request, send_file
+from flask_login import current_user, login_required
+from flask_restful import Api, Resource, inputs, reqparse
 
-from keyserv.keymanager import (Origin, activate_key_unsafe, key_exists_const,
-                                key_get_unsafe, key_valid_const)
+from keyserv.audit import search_all_logs
+from keyserv.edge import edge
+from keyserv.keymanager import (BULK_ACTIONS, Origin, activate_key_unsafe,
+                                bulk_update_keys, key_exists_const,
+                                key_get_unsafe, key_valid_const,
+                                keys_valid_const, record_edge_checks)
 from keyserv.models import Application
+from keyserv.pool import pools
+from keyserv.snapshot import (DeltaTooLarge, cached_snapshot,
+                              has_snapshot_token, parse_time,
+                              require_snapshot_token, snapshot_delta)
+from keyserv.stream import serialize_log
 
 api = Api()
 
@@ -48,11 +58,18 @@ class ActivateKey(Resource):
         parser.add_argument("user", required=True)
         parser.add_argument("app_id", required=True, type=int)
         parser.add_argument("hwid", required=True)
+        # client address of activations forwarded by an edge node
+        parser.add_argument("origin_ip")
 
         args = parser.parse_args()
 
-        origin = Origin(request.remote_addr, args.machine,
-                        args.user, args.hwid)
+        if edge.enabled:
+            return edge.node.activate(args)
+
+        ip = request.remote_addr
+        if args.origin_ip and has_snapshot_token():
+            ip = args.origin_ip
+        origin = Origin(ip, args.machine, args.user, args.hwid)
 
         if not key_exists_const(args.app_id, args.token, origin):
 
@@ -95,11 +112,184 @@ class CheckKey(Resource):
         origin = Origin(request.remote_addr,
                         args.machine, args.user, args.hwid)
 
-        if key_valid_const(args.app_id, args.token, origin):
+        if edge.enabled:
+            valid = edge.node.check(args.app_id, [(args.token, origin)])[0]
+        else:
+            valid = key_valid_const(args.app_id, args.token, origin)
+
+        if valid:
             return {"result": "ok"}, 201
 
         return {"result": "failure", "error": "invalid key"}, 404
 
 
+class CheckKeys(Resource):
+    """Endpoint used for checking several keys in one request."""
+
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument("app_id", required=True, type=int)
+        parser.add_argument("checks", required=True, type=dict,
+                            action="append")
+
+        args = parser.parse_args()
+
+        limit = current_app.config.get("CHECK_BATCH_LIMIT", 100)
+        if len(args.checks) > limit:
+            return {"result": "failure",
+                    "error": f"at most {limit} checks per request"}, 400
+
+        checks = []
+        for check in args.checks:
+            if not all(isinstance(check.get(field), str) for field in
+                       ("token", "machine", "user", "hwid")):
+                return {"result": "failure",
+                        "error": "each check needs a token, machine, user "
+                                 "and hwid"}, 400
+            checks.append((check["token"], Origin(
+                request.remote_addr, check["machine"], check["user"],
+                check["hwid"])))
+
+        if edge.enabled:
+            valid = edge.node.check(args.app_id, checks)
+        else:
+            valid = keys_valid_const(args.app_id, checks)
+
+        return {"result": "ok", "results": [
+            {"token": token, "result": "ok" if ok else "failure"}
+            for (token, _), ok in zip(checks, valid)]}, 200
+
+
+class SearchLogs(Resource):
+    """Endpoint used by administrators to search the audit log."""
+
+    method_decorators = [login_required]
+
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument("ip")
+        parser.add_argument("machine")
+        parser.add_argument("user")
+        parser.add_argument("hwid")
+        parser.add_argument("actor")
+        parser.add_argument("key_id", type=int)
+        parser.add_argument("app_id", type=int)
+        parser.add_argument("event", type=int)
+        parser.add_argument("since", type=inputs.datetime_from_iso8601)
+        parser.add_argument("until", type=inputs.datetime_from_iso8601)
+        parser.add_argument("before_id", type=int)
+        parser.add_argument("limit", type=inputs.int_range(1, 1000),
+                            default=100)
+
+        args = parser.parse_args()
+
+        logs = search_all_logs(args.ip, args.machine, args.user, args.hwid,
+                               args.actor, args.key_id, args.app_id,
+                               args.event, args.since, args.until,
+                               args.before_id, args.limit)
+
+        return {"result": "ok",
+                "logs": [serialize_log(log) for log in logs]}, 200
+
+
+class BulkKeys(Resource):
+    """Endpoint used by administrators to update many keys at once."""
+
+    method_decorators = [login_required]
+
+    def post(self):
+        # JSON only: the session cookie authenticates this endpoint, and a
+        # cross-site form post cannot send JSON without a CORS preflight
+        parser = reqparse.RequestParser()
+        parser.add_argument("action", required=True, choices=BULK_ACTIONS,
+                            location="json")
+        parser.add_argument("value", location="json")
+        parser.add_argument("app_id", type=int, location="json")
+        parser.add_argument("enabled", type=inputs.boolean, location="json")
+        parser.add_argument("memo", location="json")
+        parser.add_argument("tokens", action="append", location="json")
+        parser.add_argument("all", type=inputs.boolean, default=False,
+                            location="json")
+
+        args = parser.parse_args()
+
+        try:
+            updated = bulk_update_keys(
+                args.action, args.value, args.app_id, args.enabled, args.memo,
+                args.tokens, Origin(request.remote_addr, None, None),
+                current_user.username,
+                current_app.config.get("BULK_CHUNK_SIZE", 1000),
+                all_keys=args["all"])
+        except ValueError as error:
+            return {"result": "failure", "error": str(error)}, 400
+
+        return {"result": "ok", "updated": updated}, 200
+
+
+class PoolStats(Resource):
+    """Endpoint used by administrators to watch the database pools of the
+    worker answering."""
+
+    method_decorators = [login_required]
+
+    def get(self):
+        return dict(result="ok", **pools.stats()), 200
+
+
+class SnapshotDelta(Resource):
+    """Endpoint edge nodes fetch snapshot changes from."""
+
+    method_decorators = [require_snapshot_token]
+
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument("since", required=True, type=parse_time)
+
+        args = parser.parse_args()
+
+        try:
+            return snapshot_delta(args.since), 200
+        except DeltaTooLarge as error:
+            return {"result": "failure", "error": str(error)}, 409
+
+
+class FullSnapshot(Resource):
+    """Endpoint edge nodes download a whole snapshot from."""
+
+    method_decorators = [require_snapshot_token]
+
+    def get(self):
+        return send_file(cached_snapshot(),
+                         mimetype="application/vnd.sqlite3")
+
+
+class EdgeChecks(Resource):
+    """Endpoint edge nodes report the checks they answered to."""
+
+    method_decorators = [require_snapshot_token]
+
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument("checks", required=True, type=dict,
+                            action="append")
+
+        args = parser.parse_args()
+
+        try:
+            recorded = record_edge_checks(args.checks)
+        except (KeyError, TypeError, ValueError) as error:
+            return {"result": "failure",
+                    "error": f"malformed check report: {error}"}, 400
+
+        return {"result": "ok", "recorded": recorded}, 200
+
+
 api.add_resource(ActivateKey, "/api/activate")
 api.add_resource(CheckKey, "/api/check")
+api.add_resource(CheckKeys, "/api/check/batch")
+api.add_resource(SearchLogs, "/api/logs")
+api.add_resource(BulkKeys, "/api/keys/bulk")
+api.add_resource(PoolStats, "/api/pool")
+api.add_resource(SnapshotDelta, "/api/snapshot")
+api.add_resource(FullSnapshot, "/api/snapshot/full")
+api.add_resource(EdgeChecks, "/api/snapshot/checks")
@@ -20,9 +20,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 
 from flask_wtf import FlaskForm
-from wtforms import (BooleanField, IntegerField, PasswordField, SelectField,
-                     StringField, SubmitField)
-from wtforms.validators import required
+from flask_wtf.file import FileField
+from wtforms import (BooleanField, DateTimeField, IntegerField,
+                     PasswordField, SelectField, StringField, SubmitField,
+                     TextAreaField)
+from wtforms.validators import optional, required
 
 
 class LoginForm(FlaskForm):
@@ -41,9 +43,41 @@ class KeyForm(FlaskForm):
     active = BooleanField("Active", default=True)
     memo = StringField("Memo")
     hwid = StringField("Hardware Id")
+    expires = DateTimeField("Expires (UTC, YYYY-MM-DD HH:MM, blank for never)",
+                            [optional()], format="%Y-%m-%d %H:%M")
     submit = SubmitField("Submit")
 
 
+class BulkKeyForm(FlaskForm):
+    action = SelectField("Action", choices=[
+        ("disable", "Disable"),
+        ("enable", "Enable"),
+        ("activations", "Set Remaining Activations"),
+        ("move", "Move to Application"),
+        ("clear_hwid", "Clear Hardware Id")])
+    value = StringField("Activations or Application Id")
+    application = SelectField("Only Keys for Application", coerce=int)
+    enabled = SelectField("Only Keys That Are", choices=[
+        ("", "Active or Inactive"), ("yes", "Active"), ("no", "Inactive")])
+    memo = StringField("Only Keys with Memo Containing")
+    tokens = TextAreaField("Only These Tokens (one per line)")
+    tokens_file = FileField("Or Upload a Token List")
+    all_keys = BooleanField("Apply to All Keys When No Filter Is Set")
+    submit = SubmitField("Apply")
+
+
+class ImportKeysForm(FlaskForm):
+    keys_file = FileField("CSV or NDJSON File")
+    format = SelectField("Format", choices=[("csv", "CSV"),
+                                            ("ndjson", "NDJSON")])
+    application = SelectField("Application for Rows Without app_id",
+                              coerce=int)
+    duplicates = SelectField("Existing Tokens", choices=[
+        ("skip", "Skip"), ("update", "Update"), ("error", "Stop Import")])
+    skip_invalid = BooleanField("Skip Invalid Rows")
+    submit = SubmitField("Import")
+
+
 class AppForm(FlaskForm):
     name = StringField("Application Name")
     support = StringField("Support Message")
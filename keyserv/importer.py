@@ -0,0 +1,360 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import csv
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+from flask import current_app
+from flask_restful.inputs import datetime_from_iso8601
+
+from keyserv.models import Application, AuditLog, Event, Key, db
+from keyserv.sharding import shards
+
+FORMATS = ("csv", "ndjson")
+DUPLICATE_POLICIES = ("skip", "update", "error")
+
+# columns written by COPY, in order
+COPY_COLUMNS = ("token", "remaining", "app_id", "enabled", "memo", "hwid",
+                "cutdate", "expires_at", "total_activations", "total_checks",
+                "updated_at")
+
+# columns set from each field of a row; only those a row gives are updated
+# on existing keys
+FIELD_COLUMNS = {"activations": "remaining", "remaining": "remaining",
+                 "app_id": "app_id", "enabled": "enabled", "memo": "memo",
+                 "hwid": "hwid", "expires_at": "expires_at"}
+
+
+class InvalidRow(Exception):
+    """Raised when a row of an import file cannot be turned into a key."""
+    pass
+
+
+class DuplicateKey(Exception):
+    """Raised when an imported token already exists and the duplicate policy
+    is "error", or when updating its key would move it to another shard."""
+    pass
+
+
+class ImportResult:
+    """Counts of what happened to the rows of an import."""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.resumed_after = 0
+
+    def __str__(self):
+        return (f"{self.created} created, {self.updated} updated, "
+                f"{self.skipped} duplicate(s) skipped, "
+                f"{self.invalid} invalid row(s)")
+
+
+def read_rows(lines, fmt: str = "csv"):
+    """
+    Yield (line number, row dict) for every row of a CSV file with a header
+    line or an NDJSON file, reading `lines` lazily.
+
+    lines: - any iterable of text lines, such as an open file
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "ndjson":
+        for line_num, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                raise InvalidRow(f"line {line_num}: {error}")
+            if not isinstance(row, dict):
+                raise InvalidRow(f"line {line_num}: expected an object")
+            yield line_num, row
+    else:
+        raise ValueError(f"unknown import format {fmt!r}")
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "t", "yes", "y"):
+        return True
+    if text in ("0", "false", "f", "no", "n"):
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+def _utc(value: datetime) -> datetime:
+    """Convert an aware datetime to the naive UTC stored in the database."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def validate_row(line_num: int, row: dict, app_ids: set,
+                 default_app_id: int = None) -> dict:
+    """
+    Turn a row into the column values of a new key. "provided" holds the
+    columns the row gives a value for, as opposed to defaults.
+
+    Recognised fields are token (required), activations or remaining,
+    app_id, enabled, memo, hwid, cutdate and expires_at (ISO 8601, UTC).
+    Raises InvalidRow.
+    """
+    try:
+        token = str(row.get("token") or "").strip()
+        if not token:
+            raise ValueError("token is missing")
+
+        activations = row.get("activations", row.get("remaining"))
+        activations = 0 if activations in (None, "") else int(activations)
+        if activations < -1:
+            raise ValueError("activations must be -1 or greater")
+
+        app_id = row.get("app_id")
+        app_id = default_app_id if app_id in (None, "") else int(app_id)
+        if app_id not in app_ids:
+            raise ValueError(f"no application with id {app_id}")
+
+        enabled = row.get("enabled")
+        enabled = True if enabled in (None, "") else _parse_bool(enabled)
+
+        cutdate = row.get("cutdate")
+        cutdate = (datetime_from_iso8601(cutdate) if cutdate
+                   else datetime.utcnow())
+
+        expires_at = row.get("expires_at")
+        expires_at = _utc(datetime_from_iso8601(expires_at)) \
+            if expires_at else None
+    except (TypeError, ValueError) as error:
+        raise InvalidRow(f"line {line_num}: {error}")
+
+    return {"token": token, "remaining": activations, "app_id": app_id,
+            "enabled": enabled, "memo": str(row.get("memo") or ""),
+            "hwid": str(row.get("hwid") or ""), "cutdate": cutdate,
+            "expires_at": expires_at,
+            "total_activations": 0, "total_checks": 0,
+            "updated_at": datetime.utcnow(),
+            "provided": {column for field, column in FIELD_COLUMNS.items()
+                         if row.get(field) not in (None, "")}}
+
+
+def _copy_keys(keys: list):
+    """Insert keys with COPY when the database is Postgres, otherwise with a
+    bulk insert."""
+    keys = shards.assign_ids("key", keys)
+    connection = db.session.connection(mapper=Key.__mapper__)
+    raw = connection.connection
+    if connection.dialect.name != "postgresql" or \
+            not hasattr(raw.cursor(), "copy_expert"):
+        db.session.bulk_insert_mappings(Key, keys)
+        return
+
+    columns = COPY_COLUMNS + (("id",) if shards.enabled else ())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for key in keys:
+        writer.writerow([key[column] for column in columns])
+    buffer.seek(0)
+
+    # QUOTE_NONNUMERIC writes None as "", which COPY reads as an empty
+    # string unless told to take it as NULL
+    with raw.cursor() as cursor:
+        cursor.copy_expert(f"COPY key ({', '.join(columns)}) "
+                           f"FROM STDIN WITH (FORMAT csv, "
+                           f"FORCE_NULL (expires_at))", buffer)
+
+
+def _audit_import(rows, message: str, event_type: Event, actor: str):
+    """Insert one audit log per (key_id, app_id) in `rows`."""
+    now = datetime.now()
+    logs = [{
+        "key_id": key_id,
+        "app_id": app_id,
+        "message": message,
+        "event_type": int(event_type),
+        "timestamp": now,
+        "last_seen": now,
+        "count": 1,
+        "actor": actor} for key_id, app_id in rows]
+    if logs:
+        db.session.bulk_insert_mappings(AuditLog,
+                                        shards.assign_ids("audit_log", logs))
+
+
+def _existing_keys(tokens) -> dict:
+    """Map each of `tokens` that already exists, on any shard, to the shard,
+    id and app_id of its key, since tokens are unique across shards."""
+    existing = {}
+    for shard in shards.each():
+        for token, key_id, app_id in db.session.query(
+                Key.token, Key.id, Key.app_id).filter(Key.token.in_(tokens)):
+            existing[token] = (shard, key_id, app_id)
+    return existing
+
+
+def _load_batch(batch: dict, existing: dict, duplicates: str, actor: str,
+                result: ImportResult):
+    """Write one batch of validated keys, keyed by token, and their audit
+    logs to the selected shard. `existing` maps the tokens of the batch
+    that already exist there to the id and app_id of their keys. Existing
+    keys are only given the columns their row provides. Does not commit."""
+    if existing and duplicates == "update":
+        updates = []
+        for token, (key_id, app_id) in existing.items():
+            key = batch[token]
+            values = {column: key[column] for column in key["provided"]}
+            updates.append(dict(values, id=key_id,
+                                updated_at=key["updated_at"],
+                                app_id=values.get("app_id", app_id)))
+        db.session.bulk_update_mappings(Key, updates)
+        _audit_import([(key["id"], key["app_id"]) for key in updates],
+                      f"key updated from import by {actor}", Event.KeyModified,
+                      actor)
+        result.updated += len(updates)
+    else:
+        result.skipped += len(existing)
+
+    new = [{column: value for column, value in key.items()
+            if column != "provided"}
+           for token, key in batch.items() if token not in existing]
+    if not new:
+        return
+
+    _copy_keys(new)
+    result.created += len(new)
+
+    _audit_import(db.session.query(Key.id, Key.app_id).filter(
+        Key.token.in_([key["token"] for key in new])),
+        f"key imported by {actor}", Event.KeyCreated, actor)
+
+
+def _write_checkpoint(path: str, line_num: int):
+    with open(path + ".tmp", "w") as checkpoint:
+        checkpoint.write(str(line_num))
+    os.replace(path + ".tmp", path)
+
+
+def import_keys(lines, fmt: str = "csv", app_id: int = None,
+                duplicates: str = "skip", batch_size: int = 5000,
+                checkpoint: str = None, skip_invalid: bool = False,
+                actor: str = "import", progress=None) -> ImportResult:
+    """
+    Import existing keys from a CSV or NDJSON file without reading it into
+    memory. Rows are validated as they are read and loaded `batch_size` at a
+    time, each batch in its own transaction.
+
+    app_id: - application for rows that do not name one
+    duplicates: - what to do with tokens that already exist, one of
+                  DUPLICATE_POLICIES; within a batch the last row wins
+    checkpoint: - file recording the last line loaded; if it exists the
+                  import resumes after that line, and it is removed once
+                  the import finishes
+    skip_invalid: - log and count invalid rows instead of raising InvalidRow
+    progress: - optional callable given the number of rows in each batch
+    """
+    if duplicates not in DUPLICATE_POLICIES:
+        raise ValueError(f"unknown duplicate policy {duplicates!r}")
+
+    result = ImportResult()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as previous:
+            result.resumed_after = int(previous.read().strip() or 0)
+
+    app_ids = {row.id for row in db.session.query(Application.id)}
+    batch = {}
+    batch_rows = 0
+    last_line = result.resumed_after
+
+    def flush():
+        existing = _existing_keys(list(batch))
+        if existing and duplicates == "error":
+            raise DuplicateKey(f"token(s) already exist: "
+                               f"{', '.join(sorted(existing)[:10])}")
+
+        by_shard = {}
+        for token, key in batch.items():
+            shard = shards.shard_for_app(key["app_id"])
+            if token in existing:
+                if duplicates == "update" and existing[token][0] != shard \
+                        and "app_id" in key["provided"]:
+                    raise DuplicateKey(
+                        f"token {token} exists on shard "
+                        f"{existing[token][0]}, not on the {shard} shard of "
+                        f"application {key['app_id']}; imports cannot move "
+                        f"keys between shards")
+                # updated or skipped where the key is
+                shard = existing[token][0]
+            by_shard.setdefault(shard, {})[token] = key
+        for shard, keys in by_shard.items():
+            with shards.use(shard):
+                _load_batch(keys, {token: existing[token][1:]
+                                   for token in keys if token in existing},
+                            duplicates, actor, result)
+                db.session.commit()
+        if checkpoint:
+            _write_checkpoint(checkpoint, last_line)
+        if progress:
+            progress(batch_rows)
+
+    for line_num, row in read_rows(lines, fmt):
+        if line_num <= result.resumed_after:
+            continue
+
+        try:
+            key = validate_row(line_num, row, app_ids, app_id)
+        except InvalidRow as error:
+            if not skip_invalid:
+                raise
+            current_app.logger.warning(f"skipped invalid row: {error}")
+            result.invalid += 1
+            key = None
+
+        if key is not None:
+            if key["token"] in batch and duplicates == "error":
+                raise DuplicateKey(f"line {line_num}: token {key['token']} "
+                                   f"appears more than once")
+            batch[key["token"]] = key
+        batch_rows += 1
+        last_line = line_num
+
+        if batch_rows >= batch_size:
+            flush()
+            batch = {}
+            batch_rows = 0
+
+    if batch_rows:
+        flush()
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    current_app.logger.info(f"key import finished: {result}")
+    return result
@@ -24,12 +24,17 @@ import secrets
 import string
 from datetime import datetime
 from hmac import compare_digest
+from itertools import islice
 
 from flask import current_app, request
 from flask_login import current_user
-from sqlalchemy import exists
+from sqlalchemy import exists, or_
 
-from keyserv.models import AuditLog, Event, Key, db
+from keyserv.models import Application, AuditLog, Event, Key, db
+from keyserv.sharding import shards
+from keyserv.snapshot import parse_time
+
+BULK_ACTIONS = ("enable", "disable", "activations", "move", "clear_hwid")
 
 
 class ExhuastedActivations(Exception):
@@ -100,33 +105,40 @@ def generate_token_unsafe() -> str:
 
 
 def cut_key_unsafe(activations: int, app_id: int,
-                   active: bool = True, memo: str = "") -> str:
+                   active: bool = True, memo: str = "",
+                   expires_at: datetime = None) -> str:
     """
     Cuts a new key and returns the activation token.
 
     Cuts a new key with # `activations` allowed activations. -1 is considered
-    unlimited activations.
+    unlimited activations. The key stops validating at `expires_at` (UTC) if
+    given.
     """
+    shards.select_app(app_id)
     token = generate_token_unsafe()
-    key = Key(token, activations, app_id, active, memo)
+    key = Key(token, activations, app_id, active, memo,
+              expires_at=expires_at)
     key.cutdate = datetime.utcnow()
 
     db.session.add(key)
     db.session.commit()
 
     current_app.logger.info(
-        f"cut new key {key} with {activations} activation(s), memo: {memo}")
+        f"cut new key {key} with {activations} activation(s), memo: {memo}, "
+        f"expires: {expires_at}")
     AuditLog.from_key(key,
                       f"new key cut by {current_user.username} "
                       f"({request.remote_addr})",
-                      Event.KeyCreated)
+                      Event.KeyCreated,
+                      Origin(request.remote_addr, None, None),
+                      current_user.username)
 
     return token
 
 
 def disable_key_unsafe(token: str):
     """Disable a key by its token."""
-    key = Key.query.filter(Key.token == token).first()
+    key = shards.find(Key.query.filter(Key.token == token).first)
     if not key:
         current_app.logger.error(
             f"failed to disable key by non-existent token {token}")
@@ -137,6 +149,222 @@ def disable_key_unsafe(token: str):
     db.session.commit()
 
 
+def _bulk_values(action: str, value) -> dict:
+    """Translate a bulk action into the column values it sets."""
+    if action == "enable":
+        return {Key.enabled: True}
+    if action == "disable":
+        return {Key.enabled: False}
+    if action == "clear_hwid":
+        return {Key.hwid: ""}
+    if action in ("activations", "move") and value in (None, ""):
+        raise ValueError("value is required")
+    if action == "activations":
+        activations = int(value)
+        if activations < -1:
+            raise ValueError("activations must be -1 or greater")
+        return {Key.remaining: activations}
+    if action == "move":
+        if not Application.query.get(int(value)):
+            raise ValueError(f"no application with id {value}")
+        return {Key.app_id: int(value)}
+    raise ValueError(f"unknown bulk action {action!r}")
+
+
+def _chunks(iterable, size: int):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def _filter_keys(query, app_id: int = None, enabled: bool = None,
+                 memo: str = None):
+    if app_id is not None:
+        query = query.filter(Key.app_id == app_id)
+    if enabled is not None:
+        query = query.filter(Key.enabled == enabled)
+    if memo:
+        query = query.filter(Key.memo.contains(memo))
+    return query
+
+
+def _unexpired(query):
+    return query.filter(or_(Key.expires_at.is_(None),
+                            Key.expires_at > datetime.utcnow()))
+
+
+def count_keys(app_id: int = None, enabled: bool = None,
+               memo: str = None) -> int:
+    """Count the keys a filter based bulk update would touch."""
+    total = 0
+    for _ in _key_shards(app_id):
+        total += _filter_keys(db.session.query(Key.id),
+                              app_id, enabled, memo).count()
+    return total
+
+
+def _key_shards(app_id: int = None):
+    """Select each shard that can hold keys of `app_id`, or every shard."""
+    if app_id is None:
+        return shards.each()
+    shards.select_app(app_id)
+    return [shards.current()]
+
+
+def bulk_update_keys(action: str, value=None, app_id: int = None,
+                     enabled: bool = None, memo: str = None, tokens=None,
+                     origin: Origin = None, actor: str = None,
+                     chunk_size: int = 1000, progress=None,
+                     all_keys: bool = False) -> int:
+    """
+    Apply `action` to every key matching the filters, or to every key in
+    `tokens` if given, and return the number of keys updated. Raises
+    ValueError without any filter or tokens unless `all_keys` is set, so
+    a stray request cannot change the keys of every application.
+
+    Keys are updated `chunk_size` at a time, each chunk with a single UPDATE
+    and a single audit log insert in its own transaction, so a large job
+    never holds more than one chunk of ids in memory.
+
+    action: - one of BULK_ACTIONS; "activations" and "move" take `value`
+    tokens: - any iterable of tokens, e.g. the lines of an uploaded file
+    progress: - optional callable given the number of keys in each chunk
+    """
+    if not all_keys and tokens is None and app_id is None and \
+            enabled is None and not memo:
+        raise ValueError("choose the keys to change with a filter or "
+                         "tokens, or confirm changing all keys")
+
+    values = _bulk_values(action, value)
+    message = f"bulk {action}"
+    if value is not None and action in ("activations", "move"):
+        message += f" to {value}"
+    if actor:
+        message += f" by {actor}"
+    if origin:
+        message += f" ({origin.ip})"
+
+    def key_chunks():
+        query = _filter_keys(db.session.query(Key.id, Key.app_id),
+                             app_id, enabled, memo)
+        if tokens is not None:
+            for chunk in _chunks((token.strip() for token in tokens
+                                  if token.strip()), chunk_size):
+                # a chunk of tokens may be spread over several shards
+                for _ in _key_shards(app_id):
+                    yield query.filter(Key.token.in_(chunk)).all()
+            return
+
+        for _ in _key_shards(app_id):
+            last_id = 0
+            while True:
+                rows = (query.filter(Key.id > last_id)
+                        .order_by(Key.id).limit(chunk_size).all())
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                yield rows
+
+    if action == "move" and shards.enabled:
+        # keys keep their shard, so they can only move to applications on
+        # the same one; checked before the first chunk is committed. use
+        # rebalance-app to move a whole application
+        target_shard = shards.shard_for_app(int(value))
+        if app_id is None or shards.shard_for_app(app_id) != target_shard:
+            raise ValueError(f"application {value} is on shard "
+                             f"{target_shard}; only keys filtered by an "
+                             f"application on that shard can move to it")
+
+    updated = 0
+    for rows in key_chunks():
+        if not rows:
+            continue
+        _update_chunk(rows, values, message, origin, actor)
+        updated += len(rows)
+        if progress:
+            progress(len(rows))
+
+    current_app.logger.info(f"{message}: {updated} key(s) updated")
+    return updated
+
+
+def _update_chunk(rows: list, values: dict, message: str,
+                  origin: Origin = None, actor: str = None):
+    """Set `values` on the keys of `rows`, (id, app_id) pairs from the
+    selected shard, with one UPDATE and one audit log insert, and commit."""
+    Key.query.filter(Key.id.in_([row.id for row in rows])).update(
+        {**values, Key.updated_at: datetime.utcnow()},
+        synchronize_session=False)
+
+    now = datetime.now()
+    logs = [{
+        "key_id": row.id,
+        "app_id": values.get(Key.app_id, row.app_id),
+        "message": message,
+        "event_type": int(Event.KeyModified),
+        "timestamp": now,
+        "last_seen": now,
+        "count": 1,
+        "actor": actor,
+        "origin_ip": origin and origin.ip} for row in rows]
+    db.session.bulk_insert_mappings(AuditLog,
+                                    shards.assign_ids("audit_log", logs))
+    db.session.commit()
+
+
+def _due_keys(now: datetime):
+    """Enabled keys that have expired by `now`, soonest first. Served by
+    ix_key_enabled_expires_at, so only due keys are read."""
+    return (db.session.query(Key.id, Key.app_id)
+            .filter_by(enabled=True).filter(Key.expires_at <= now)
+            .order_by(Key.expires_at))
+
+
+def count_expired_keys(now: datetime = None) -> int:
+    """Count the enabled keys the next expiry sweep would disable."""
+    now = now or datetime.utcnow()
+    return sum(_due_keys(now).count() for _ in shards.each())
+
+
+def expire_keys(now: datetime = None, chunk_size: int = 1000,
+                progress=None) -> int:
+    """
+    Disable every enabled key that expired by `now` and return how many were
+    disabled. Due keys are read from the expiry index `chunk_size` at a
+    time and each chunk is disabled with one UPDATE and one audit log insert
+    in its own transaction. Disabled keys drop out of the index range, so
+    every chunk starts from the front of it again.
+
+    progress: - optional callable given the number of keys in each chunk
+    """
+    now = now or datetime.utcnow()
+    expired = 0
+    for _ in shards.each():
+        while True:
+            rows = _due_keys(now).limit(chunk_size).all()
+            if not rows:
+                break
+            _update_chunk(rows, {Key.enabled: False}, "key expired",
+                          actor="expiry")
+            expired += len(rows)
+            if progress:
+                progress(len(rows))
+
+    if expired:
+        current_app.logger.info(f"expired {expired} key(s)")
+    return expired
+
+
+def next_expiry() -> datetime:
+    """Return when the next enabled key expires, or None if none will."""
+    due = [db.session.query(db.func.min(Key.expires_at))
+           .filter_by(enabled=True).scalar() for _ in shards.each()]
+    due = [when for when in due if when is not None]
+    return min(due) if due else None
+
+
 def _compare(left: str, right: str) -> int:
     if len(left) != len(right):
         return 0
@@ -148,47 +376,111 @@ def _compare(left: str, right: str) -> int:
 
 def key_exists_const(app_id: int, token: str, origin: Origin) -> bool:
     """Constant time check to see if `token` exists in the database. Compares
-    against all keys even if a match is found."""
+    against all keys even if a match is found. Expired keys do not count."""
     current_app.logger.info(f"key lookup by token {token}")
     found = False
+    now = datetime.utcnow()
+    shards.select_app(app_id)
     for key in Key.query.all():
         if (compare_digest(token, key.token) and
-                key.enabled and key.app_id == app_id):
+                key.enabled and key.app_id == app_id
+                and not key.expired(now)):
 
             found = True
             key.last_check_ts = datetime.utcnow()
             key.last_check_ip = origin.ip
             key.total_checks += 1
-            AuditLog.from_key(key, f"key check from {origin}", Event.KeyAccess)
+            AuditLog.from_key(key, f"key check from {origin}",
+                              Event.KeyAccess, origin)
     return found
 
 
 def key_valid_const(app_id: int, token: str, origin: Origin) -> bool:
     """Constant time check to see if `token` exists in the database. Compares
     against all keys even if a match is found. Validates against the app id
-    and the hardware id provided."""
+    and the hardware id provided, and rejects expired keys."""
     current_app.logger.info(f"key lookup by token {token} from {origin}")
     found = False
+    now = datetime.utcnow()
+    shards.select_app(app_id)
     for key in Key.query.all():
         if (compare_digest(token, key.token) and
                 key.enabled and key.app_id == app_id
-                and compare_digest(origin.hwid, key.hwid)):
+                and compare_digest(origin.hwid, key.hwid)
+                and not key.expired(now)):
 
             found = True
             key.last_check_ts = datetime.utcnow()
             key.last_check_ip = origin.ip
             key.total_checks += 1
-            AuditLog.from_key(key, f"key check from {origin}", Event.KeyAccess)
+            AuditLog.from_key(key, f"key check from {origin}",
+                              Event.KeyAccess, origin)
     return found
 
+
+def keys_valid_const(app_id: int, checks: list) -> list:
+    """Batch form of key_valid_const. `checks` is a list of (token, origin)
+    pairs; returns whether each is valid, in order. Reads the keys once for
+    the whole batch and compares every key against every check."""
+    current_app.logger.info(f"batch key lookup of {len(checks)} token(s)")
+    found = [False] * len(checks)
+    now = datetime.utcnow()
+    shards.select_app(app_id)
+    for key in Key.query.all():
+        for index, (token, origin) in enumerate(checks):
+            if (compare_digest(token, key.token) and
+                    key.enabled and key.app_id == app_id
+                    and compare_digest(origin.hwid, key.hwid)
+                    and not key.expired(now)):
+
+                found[index] = True
+                key.last_check_ts = datetime.utcnow()
+                key.last_check_ip = origin.ip
+                key.total_checks += 1
+                AuditLog.from_key(key, f"key check from {origin}",
+                                  Event.KeyAccess, origin)
+    return found
+
+
+def record_edge_checks(checks: list) -> int:
+    """
+    Record checks an edge node answered from its snapshot. Each entry holds
+    the app_id, key_id, ip, machine, user and hwid of the checks, their
+    count and last_check_ts. Returns the number of entries recorded;
+    entries for keys that no longer exist are skipped.
+    """
+    recorded = 0
+    for check in checks:
+        shards.select_app(check["app_id"])
+        key = Key.query.get(check["key_id"])
+        if key is None or key.app_id != check["app_id"]:
+            continue
+
+        origin = Origin(check["ip"], check["machine"], check["user"],
+                        check["hwid"])
+        checked_at = parse_time(check["last_check_ts"])
+        key.total_checks += check["count"]
+        if key.last_check_ts is None or key.last_check_ts < checked_at:
+            key.last_check_ts = checked_at
+            key.last_check_ip = origin.ip
+        AuditLog.from_key(key, f"key check from {origin} (edge)",
+                          Event.KeyAccess, origin, events=check["count"])
+        recorded += 1
+    db.session.commit()
+    return recorded
+
+
 def key_get_unsafe(app_id: int, token: str, origin) -> Key:
     """Get a key by its token using constant time comparison."""
 
     current_app.logger.info(f"key retreival by token {token} from {origin}")
 
-    key = Key.query.filter_by(app_id=app_id, token=token, enabled=True).first()
+    shards.select_app(app_id)
+    key = _unexpired(Key.query.filter_by(app_id=app_id, token=token,
+                                         enabled=True)).first()
     if key:
-        AuditLog.from_key(key, f"key retreival from {origin}", Event.KeyAccess)
+        AuditLog.from_key(key, f"key retreival from {origin}",
+                          Event.KeyAccess, origin)
         return key
     return None
 
@@ -199,7 +491,9 @@ def activate_key_unsafe(app_id: int, token: str, origin: Origin):
 
     `ip`, `machine`, and `user` are of the originating activation attempt.
     """
-    key = Key.query.filter_by(token=token, app_id=app_id, enabled=True).first()
+    shards.select_app(app_id)
+    key = _unexpired(Key.query.filter_by(token=token, app_id=app_id,
+                                         enabled=True)).first()
 
     if key.remaining == -1:
         key.hwid = origin.hwid
@@ -207,7 +501,7 @@ def activate_key_unsafe(app_id: int, token: str, origin: Origin):
             f"new unlimited activation: Key {key!r} from {origin}")
         AuditLog.from_key(
             key, f"new unlimited activation from from {origin}",
-            Event.AppActivation)
+            Event.AppActivation, origin)
         return
 
     if key.remaining == 0:
@@ -215,7 +509,7 @@ def activate_key_unsafe(app_id: int, token: str, origin: Origin):
             f"failed activation attempt: Key {key!r} from {origin}")
         AuditLog.from_key(
             key, f"failed activation attempt from {origin}",
-            Event.FailedActivation)
+            Event.FailedActivation, origin)
 
         raise ExhuastedActivations(
             f"token {token} has exhausted all remaining activations")
@@ -231,6 +525,6 @@ def activate_key_unsafe(app_id: int, token: str, origin: Origin):
     key.hwid = origin.hwid
 
     AuditLog.from_key(
-        key, f"new activation from {origin}", Event.AppActivation)
+        key, f"new activation from {origin}", Event.AppActivation, origin)
 
     db.session.commit()
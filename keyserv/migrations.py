@@ -0,0 +1,242 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from keyserv.models import db
+from keyserv.sharding import SHARD_TABLES
+
+MIGRATIONS = []
+
+
+class SchemaVersion(db.Model):
+    """A schema migration that has been applied to the database."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String)
+    applied = db.Column(db.DateTime)
+
+
+def migration(version: int, description: str):
+    """Register a function as the migration to schema `version`. Migrations
+    must be safe to run against a schema that already has their changes,
+    since databases created by initdb start out with everything."""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+
+class Migrator:
+    """DDL helpers handed to each migration."""
+
+    def __init__(self, engine, online: bool = True, log=print,
+                 batch_size: int = 10000):
+        self.engine = engine
+        self.online = online and engine.dialect.name == "postgresql"
+        self.log = log
+        self.batch_size = batch_size
+
+    def execute(self, statement: str):
+        self.log(f"  {statement}")
+        with self.engine.begin() as connection:
+            connection.execute(statement)
+
+    def backfill(self, table: str, assignments: str, where: str, **params):
+        """
+        Run UPDATE `table` SET `assignments` WHERE `where` over batch_size
+        ids at a time, each batch in its own transaction, so large tables
+        are not locked or rewritten in one go and an interrupted backfill
+        continues where it stopped.
+        """
+        quoted = self.quote(table)
+        with self.engine.connect() as connection:
+            low, high = connection.execute(
+                f"SELECT min(id), max(id) FROM {quoted}").first()
+        if low is None:
+            return
+
+        self.log(f"  UPDATE {quoted} SET {assignments} WHERE {where} "
+                 f"({self.batch_size} ids at a time)")
+        statement = text(f"UPDATE {quoted} SET {assignments} WHERE ({where}) "
+                         f"AND id >= :_start AND id < :_end")
+        for start in range(low, high + 1, self.batch_size):
+            with self.engine.begin() as connection:
+                connection.execute(statement, _start=start,
+                                   _end=start + self.batch_size, **params)
+
+    def quote(self, name: str) -> str:
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def add_column(self, table: str, column: db.Column):
+        """Add `column` to `table` unless it already exists."""
+        existing = {col["name"] for col in inspect(self.engine)
+                    .get_columns(table)}
+        if column.name in existing:
+            return
+
+        ddl = (f"ALTER TABLE {self.quote(table)} ADD COLUMN "
+               f"{self.quote(column.name)} "
+               f"{column.type.compile(self.engine.dialect)}")
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        self.execute(ddl)
+
+    def create_index(self, name: str, table: str, *columns: str):
+        """
+        Create an index unless it already exists. On Postgres the index is
+        built with CREATE INDEX CONCURRENTLY when running online, so reads
+        and writes continue while it builds; an invalid index left behind by
+        an interrupted build is dropped and rebuilt.
+        """
+        ddl = (f"{name} ON {self.quote(table)} "
+               f"({', '.join(self.quote(column) for column in columns)})")
+        if not self.online:
+            self.execute(f"CREATE INDEX IF NOT EXISTS {ddl}")
+            return
+
+        with self.engine.connect() as connection:
+            invalid = connection.execute(
+                "SELECT 1 FROM pg_index JOIN pg_class "
+                "ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = %s AND NOT pg_index.indisvalid",
+                (name,)).scalar()
+
+        autocommit = self.engine.execution_options(
+            isolation_level="AUTOCOMMIT")
+        with autocommit.connect() as connection:
+            if invalid:
+                self.log(f"  DROP INDEX CONCURRENTLY {name}")
+                connection.execute(f"DROP INDEX CONCURRENTLY {name}")
+            self.log(f"  CREATE INDEX CONCURRENTLY IF NOT EXISTS {ddl}")
+            connection.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {ddl}")
+
+
+def current_version(engine=None) -> int:
+    """Return the newest applied migration, 0 for an unversioned database.
+
+    engine: - database to check, defaults to the main database
+    """
+    engine = engine or db.engine
+    if SchemaVersion.__tablename__ not in inspect(engine).get_table_names():
+        return 0
+    with engine.connect() as connection:
+        return connection.execute(
+            db.select([db.func.max(SchemaVersion.version)])).scalar() or 0
+
+
+def head_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def _record(engine, version: int, description: str):
+    with engine.begin() as connection:
+        connection.execute(SchemaVersion.__table__.insert().values(
+            version=version, description=description,
+            applied=datetime.utcnow()))
+
+
+def stamp(engine=None):
+    """Mark a freshly created schema as having every migration applied."""
+    engine = engine or db.engine
+    applied = current_version(engine)
+    for version, description, _ in MIGRATIONS:
+        if version > applied:
+            _record(engine, version, description)
+
+
+def upgrade(online: bool = True, log=print, engine=None) -> int:
+    """
+    Apply every migration newer than the database's version, in order, and
+    return the number applied. Tables that do not exist yet are created
+    first, so this also works on an empty database.
+
+    engine: - database to upgrade, defaults to the main database. Other
+              databases are shards and only get the sharded tables
+    """
+    if engine is None or engine is db.engine:
+        engine = db.engine
+        db.create_all()
+    else:
+        db.metadata.create_all(bind=engine, tables=[
+            db.metadata.tables[name] for name in SHARD_TABLES])
+    migrator = Migrator(engine, online, log)
+    applied = 0
+
+    for version, description, func in MIGRATIONS:
+        if version <= current_version(engine):
+            continue
+        log(f"migrating to {version}: {description}")
+        func(migrator)
+        _record(engine, version, description)
+        applied += 1
+
+    return applied
+
+
+@migration(1, "structured origin and actor columns on audit_log")
+def _audit_origin(migrator: Migrator):
+    for name in ("origin_ip", "origin_machine", "origin_user", "origin_hwid",
+                 "actor"):
+        migrator.add_column("audit_log", db.Column(name, db.String))
+        migrator.create_index(f"ix_audit_log_{name}", "audit_log", name)
+
+
+@migration(2, "aggregated audit_log rows")
+def _audit_aggregate(migrator: Migrator):
+    migrator.add_column("audit_log", db.Column("count", db.Integer,
+                                               nullable=False,
+                                               server_default="1"))
+    migrator.add_column("audit_log", db.Column("last_seen", db.DateTime))
+    migrator.backfill("audit_log", f"last_seen = {migrator.quote('timestamp')}",
+                      "last_seen IS NULL")
+
+
+@migration(3, "indexes for key and audit_log lookups")
+def _lookup_indexes(migrator: Migrator):
+    migrator.create_index("ix_key_app_id", "key", "app_id")
+    migrator.create_index("ix_audit_log_key_event_ts", "audit_log",
+                          "key_id", "event_type", "timestamp")
+    migrator.create_index("ix_audit_log_app_id", "audit_log", "app_id")
+    migrator.create_index("ix_audit_log_timestamp", "audit_log", "timestamp")
+
+
+@migration(4, "change tracking for key, application and audit_log")
+def _change_tracking(migrator: Migrator):
+    for table in ("key", "application"):
+        migrator.add_column(table, db.Column("updated_at", db.DateTime))
+        # updated_at is UTC, unlike the database's CURRENT_TIMESTAMP
+        migrator.backfill(table, "updated_at = :now", "updated_at IS NULL",
+                          now=datetime.utcnow())
+    migrator.create_index("ix_key_updated_at", "key", "updated_at")
+    migrator.create_index("ix_audit_log_last_seen", "audit_log", "last_seen")
+
+
+@migration(5, "key expiry")
+def _key_expiry(migrator: Migrator):
+    migrator.add_column("key", db.Column("expires_at", db.DateTime))
+    migrator.create_index("ix_key_enabled_expires_at", "key",
+                          "enabled", "expires_at")
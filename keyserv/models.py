@@ -20,19 +20,53 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from datetime import datetime
+import random
+from datetime import datetime, timedelta
 from enum import IntEnum
 from typing import Any  # NOQA: F401
 
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, inspect, orm
 
-db = SQLAlchemy()  # type: Any
+# tables spread over the shards when sharding is enabled. everything else
+# lives in the main database
+SHARDED_TABLES = ("key", "audit_log")
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends queries on sharded tables to the shard selected
+    by keyserv.sharding, and everything else to the main database."""
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get("shards")
+        if router is not None and router.enabled and mapper is not None \
+                and mapper.persist_selectable.name in SHARDED_TABLES:
+            return router.engine(router.current())
+        return super().get_bind(mapper, clause)
+
+
+class KeyservSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        pools = app.extensions.get("pools")
+        if pools is not None:
+            pools.engine_options(sa_url, options)
+
+
+db = KeyservSQLAlchemy()  # type: Any
 
 
 class Application(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
     support_message = db.Column(db.String)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
 
 
 class Key(db.Model):
@@ -44,10 +78,15 @@ class Key(db.Model):
     remaining: remaining activations for a key. -1 if unlimited
     enabled: if the license is able to
     """
+    __table_args__ = (
+        # the expiry sweep's lookup of enabled keys that are due
+        db.Index("ix_key_enabled_expires_at", "enabled", "expires_at"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     app = db.relationship("Application", uselist=False, backref="keys")
-    app_id = db.Column(db.Integer,
-                       db.ForeignKey("application.id"), nullable=False)
+    app_id = db.Column(db.Integer, db.ForeignKey("application.id"),
+                       nullable=False, index=True)
     cutdate = db.Column(db.DateTime(timezone=True))
     enabled = db.Column(db.Boolean, default=True)
     memo = db.Column(db.String)
@@ -60,20 +99,46 @@ class Key(db.Model):
     last_activation_ip = db.Column(db.String)
     last_check_ts = db.Column(db.DateTime)
     last_check_ip = db.Column(db.String)
+    # UTC time after which the key is no longer valid, None if never
+    expires_at = db.Column(db.DateTime)
+    # last change to a column in TRACKED_COLUMNS
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    # columns that change what a key validates against or how it is listed.
+    # the check counters are left out so polling clients do not count as
+    # changes. bulk updates that bypass the ORM must set updated_at
+    # themselves.
+    TRACKED_COLUMNS = ("app_id", "enabled", "memo", "hwid", "remaining",
+                       "token", "expires_at")
 
     def __init__(self, token: str, remaining: int, app_id: int,
-                 enabled: bool = True, memo: str = "", hwid: str = "") -> None:
+                 enabled: bool = True, memo: str = "", hwid: str = "",
+                 expires_at: datetime = None) -> None:
         self.token = token
         self.remaining = remaining
         self.enabled = enabled
         self.memo = memo
         self.app_id = app_id
         self.hwid = hwid
+        self.expires_at = expires_at
+
+    def expired(self, now: datetime = None) -> bool:
+        """Whether the key has passed its expiry time."""
+        return self.expires_at is not None and \
+            self.expires_at <= (now or datetime.utcnow())
 
     def __str__(self):
         return f"<Key({self.token})>"
 
 
+@event.listens_for(Key, "before_update")
+def _touch_key(mapper, connection, key: Key):
+    state = inspect(key)
+    if any(state.attrs[column].history.has_changes()
+           for column in Key.TRACKED_COLUMNS):
+        key.updated_at = datetime.utcnow()
+
+
 class Event(IntEnum):
     Info = 0
     Warn = 1
@@ -91,25 +156,128 @@ class AuditLog(db.Model):
     """
     Database representation of an audit log.
     """
+    __table_args__ = (
+        # key logs, and the lookup of the row to aggregate an event into
+        db.Index("ix_audit_log_key_event_ts",
+                 "key_id", "event_type", "timestamp"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     app = db.relationship("Application", backref="logs")
-    app_id = db.Column(db.Integer, db.ForeignKey("application.id"), nullable=False)
+    app_id = db.Column(db.Integer, db.ForeignKey("application.id"),
+                       nullable=False, index=True)
     event_type = db.Column(db.Integer)
     key = db.relationship("Key", uselist=False, backref="logs")
     key_id = db.Column(db.Integer, db.ForeignKey("key.id"), nullable=False)
     message = db.Column(db.String)
-    timestamp = db.Column(db.DateTime)
+    timestamp = db.Column(db.DateTime, index=True)
+    origin_ip = db.Column(db.String, index=True)
+    origin_machine = db.Column(db.String, index=True)
+    origin_user = db.Column(db.String, index=True)
+    origin_hwid = db.Column(db.String, index=True)
+    actor = db.Column(db.String, index=True)
+    # number of events this row stands for when aggregated or sampled
+    count = db.Column(db.Integer, default=1, nullable=False)
+    # bumped when an aggregated row counts another event
+    last_seen = db.Column(db.DateTime, index=True)
 
     def __init__(self, key_id: int, app_id: int,
-                 message: str, event_type: Event) -> None:
+                 message: str, event_type: Event,
+                 origin=None, actor: str = None) -> None:
         self.key_id = key_id
         self.app_id = app_id
         self.message = message
         self.event_type = int(event_type)
         self.timestamp = datetime.now()
+        self.last_seen = self.timestamp
+        self.count = 1
+        self.actor = actor
+
+        if origin is not None:
+            self.origin_ip = origin.ip
+            self.origin_machine = origin.machine
+            self.origin_user = origin.user
+            self.origin_hwid = origin.hwid
 
     @classmethod
-    def from_key(cls, key: Key, message: str, event_type: Event):
-        audit = cls(key.id, key.app.id, message, event_type)
+    def from_key(cls, key: Key, message: str, event_type: Event,
+                 origin=None, actor: str = None, events: int = 1):
+        """
+        Record an audit event for `key`.
+
+        origin: - the keymanager.Origin of an API request, if any
+        actor: - username of the admin that performed the action, if any
+        events: - number of identical events to record, e.g. checks counted
+                  by an edge node
+
+        How the event is stored depends on the AUDIT_POLICY config entry for
+        the event type: "full" writes a row per event, "aggregate" counts
+        events per key and origin in rows covering AUDIT_AGGREGATE_INTERVAL
+        seconds, "sample" writes AUDIT_SAMPLE_RATE of events with a count
+        that estimates the events skipped, and "none" writes nothing.
+        Written rows are also sent to the live audit stream.
+        """
+        config = current_app.config
+        stream = current_app.extensions.get("audit_stream")
+        policy = config.get("AUDIT_POLICY", {}).get(
+            Event(event_type).name, "full")
+        count = events
+
+        if policy == "none":
+            return
+        elif policy == "sample":
+            rate = config.get("AUDIT_SAMPLE_RATE", 0.01)
+            count = sum(random.random() < rate for _ in range(events))
+            if not count:
+                return
+            count *= max(1, round(1 / rate))
+        elif policy == "aggregate":
+            interval = config.get("AUDIT_AGGREGATE_INTERVAL", 3600)
+            row_id = cls._aggregate(key, event_type, origin, actor, interval,
+                                    events)
+            if row_id is not None:
+                if stream is not None and stream.active:
+                    stream.stage(row_id)
+                db.session.commit()
+                return
+        elif policy != "full":
+            raise ValueError(f"unknown audit policy {policy!r} for "
+                             f"{Event(event_type).name}")
+
+        audit = cls(key.id, key.app.id, message, event_type, origin, actor)
+        audit.count = count
         db.session.add(audit)
+        if stream is not None and stream.active:
+            db.session.flush()
+            stream.stage(audit.id, audit)
         db.session.commit()
+
+    @classmethod
+    def _aggregate(cls, key: Key, event_type: Event, origin, actor: str,
+                   interval: int, events: int = 1) -> int:
+        """Count `events` events against the newest row for the same key,
+        origin and event type if that row started less than `interval`
+        seconds ago. Returns the row's id, or None when there is no such
+        row."""
+        now = datetime.now()
+        origin_columns = {"origin_ip": None, "origin_machine": None,
+                          "origin_user": None, "origin_hwid": None}
+        if origin is not None:
+            origin_columns = {"origin_ip": origin.ip,
+                              "origin_machine": origin.machine,
+                              "origin_user": origin.user,
+                              "origin_hwid": origin.hwid}
+
+        row = (db.session.query(cls.id)
+               .filter_by(key_id=key.id, event_type=int(event_type),
+                          actor=actor, **origin_columns)
+               .filter(cls.timestamp >= now - timedelta(seconds=interval))
+               .order_by(cls.id.desc())
+               .first())
+        if row is None:
+            return None
+
+        cls.query.filter_by(id=row.id).update(
+            {cls.count: cls.count + events, cls.last_seen: now},
+            synchronize_session=False)
+        return row.id
@@ -0,0 +1,164 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+from datetime import datetime, timedelta
+
+from keyserv.audit import search_logs
+from keyserv.models import Application, AuditLog, Event, Key, db
+from keyserv.sharding import shards
+
+
+def hot_queries() -> list:
+    """
+    (name, query) pairs for the queries the API and admin pages run on every
+    request. The constant time scans in key_exists_const and key_valid_const
+    read every key on purpose and are not listed.
+    """
+    since = datetime.now() - timedelta(days=7)
+    return [
+        ("key by token", Key.query.filter_by(app_id=1, token="TOKEN",
+                                             enabled=True)),
+        ("keys for app", Key.query.filter_by(app_id=1)),
+        ("key id page", Key.query.filter(Key.id > 1000)
+            .order_by(Key.id).limit(1000)),
+        ("expiry sweep", Key.query.filter_by(enabled=True)
+            .filter(Key.expires_at <= datetime.utcnow())
+            .order_by(Key.expires_at).limit(1000)),
+        ("logs for key", AuditLog.query.filter_by(key_id=1)),
+        ("logs for app", AuditLog.query.filter_by(app_id=1)),
+        ("log aggregation lookup", AuditLog.query.filter_by(
+            key_id=1, event_type=int(Event.KeyAccess), origin_ip="127.0.0.1")
+            .filter(AuditLog.timestamp >= since)
+            .order_by(AuditLog.id.desc())),
+        ("log page", search_logs(before_id=1000)),
+        ("logs by ip", search_logs(ip="127.0.0.1")),
+        ("logs by hwid", search_logs(hwid="HWID")),
+        ("logs by actor", search_logs(actor="admin")),
+        ("logs since", search_logs(since=since)),
+    ]
+
+
+def _compile(query, dialect) -> str:
+    return str(query.statement.compile(
+        dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+
+def _postgres_scans(connection, sql: str) -> tuple:
+    plan = connection.execute(f"EXPLAIN (FORMAT JSON) {sql}").scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    scans = []
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if node["Node Type"] == "Seq Scan":
+            scans.append(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return json.dumps(plan, indent=1), scans
+
+
+def _sqlite_scans(connection, sql: str) -> tuple:
+    rows = connection.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    details = [row[-1] for row in rows]
+    return "\n".join(details), [detail for detail in details
+                                if detail.startswith("SCAN ")]
+
+
+def seed(count: int, apps: int = 20):
+    """Add `count` keys spread over `apps` applications, with a year of
+    audit logs, to the current transaction so the planner sees realistic
+    table sizes and value distributions. The applications are written next
+    to the keys, so on the selected shard when sharding is enabled."""
+    prefix = f"plancheck-{datetime.now().timestamp()}"
+    connection = db.session.connection(mapper=Key.__mapper__)
+    app_ids = []
+    for i in range(apps):
+        app_ids.append(connection.execute(Application.__table__.insert()
+                                          .values(name=f"{prefix}-{i}"))
+                       .inserted_primary_key[0])
+
+    db.session.bulk_insert_mappings(Key, shards.assign_ids("key", [{
+        "token": f"{prefix}-{i}", "remaining": 1,
+        "app_id": app_ids[i % apps], "enabled": True, "memo": "",
+        "hwid": f"HWID{i}"} for i in range(count)]))
+
+    now = datetime.now()
+    logs = []
+    for i, (key_id, app_id) in enumerate(db.session.query(Key.id, Key.app_id)
+                                         .filter(Key.app_id.in_(app_ids))):
+        timestamp = now - timedelta(days=365 * i / count)
+        for event in (Event.KeyCreated, Event.KeyAccess):
+            logs.append({
+                "key_id": key_id, "app_id": app_id, "message": "plancheck",
+                "event_type": int(event), "timestamp": timestamp,
+                "last_seen": timestamp, "count": 1,
+                "origin_ip": f"10.{i % 256}.{i // 256 % 256}.1",
+                "origin_hwid": f"HWID{i}"})
+    db.session.bulk_insert_mappings(AuditLog,
+                                    shards.assign_ids("audit_log", logs))
+    db.session.flush()
+
+
+def check_plans(seed_rows: int = 0, log=print) -> bool:
+    """
+    EXPLAIN every hot query and report any that read a whole table. On
+    Postgres sequential scans are disabled while planning, so a plan only
+    contains one if no index can serve the query at all.
+
+    seed_rows: - keys to add first; they are rolled back afterwards
+
+    Checks the selected shard when sharding is enabled.
+
+    Returns True if no query scans a table.
+    """
+    ok = True
+    try:
+        if seed_rows:
+            seed(seed_rows)
+
+        connection = db.session.connection(mapper=Key.__mapper__)
+        dialect = connection.dialect.name
+        if dialect == "postgresql":
+            connection.execute("ANALYZE key")
+            connection.execute("ANALYZE audit_log")
+            connection.execute("SET LOCAL enable_seqscan = off")
+            explain = _postgres_scans
+        elif dialect == "sqlite":
+            connection.execute("ANALYZE")
+            explain = _sqlite_scans
+        else:
+            raise ValueError(f"query plans cannot be checked on {dialect}")
+
+        for name, query in hot_queries():
+            plan, scans = explain(connection,
+                                  _compile(query, connection.dialect))
+            if scans:
+                ok = False
+                log(f"FAIL {name}: scans {', '.join(scans)}\n{plan}")
+            else:
+                log(f"ok   {name}")
+    finally:
+        db.session.rollback()
+
+    return ok
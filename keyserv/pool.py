@@ -0,0 +1,259 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import threading
+import time
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from keyserv.sharding import shards
+
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:  # not running under uWSGI
+    uwsgi = postfork = None
+
+# client-facing endpoints held to DB_API_STATEMENT_TIMEOUT
+API_ENDPOINTS = ("activatekey", "checkkey", "checkkeys")
+
+
+class MonitoredPool(QueuePool):
+    """QueuePool that counts checkouts, new connections and checkout
+    timeouts, and times how long checkouts wait."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def _create_connection(self):
+        with self._stats_lock:
+            self.connects += 1
+        return super()._create_connection()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {"size": self.size(), "idle": self.checkedin(),
+                    "checked_out": self.checkedout(),
+                    "overflow": max(0, self.overflow()),
+                    "checkouts": self.checkouts, "connects": self.connects,
+                    "timeouts": self.timeouts,
+                    "wait_avg_ms": round(1000 * self.wait_total
+                                         / max(1, self.checkouts), 3),
+                    "wait_max_ms": round(1000 * self.wait_max, 3)}
+
+
+def _positive(config, name: str, default, minimum=1, optional=False):
+    value = config.get(name, default)
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) \
+            or value < minimum:
+        raise ValueError(f"{name} must be a number of at least {minimum}, "
+                         f"not {value!r}")
+    return value
+
+
+def pool_settings(config) -> dict:
+    """Read and validate the DB_* pool settings, raising ValueError on the
+    first invalid one."""
+    settings = {
+        "pool_size": _positive(config, "DB_POOL_SIZE", 5),
+        "max_overflow": _positive(config, "DB_MAX_OVERFLOW", 10, minimum=0),
+        "pool_timeout": _positive(config, "DB_POOL_TIMEOUT", 10),
+        "pool_recycle": _positive(config, "DB_POOL_RECYCLE", 1800,
+                                  minimum=-1),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+        "prewarm": _positive(config, "DB_POOL_PREWARM", 0, minimum=0),
+        "connect_timeout": _positive(config, "DB_CONNECT_TIMEOUT", 5,
+                                     optional=True),
+        "statement_timeout": _positive(config, "DB_STATEMENT_TIMEOUT", None,
+                                       optional=True),
+        "api_statement_timeout": _positive(config, "DB_API_STATEMENT_TIMEOUT",
+                                           None, optional=True),
+        "pgbouncer": config.get("DB_PGBOUNCER", False),
+    }
+    for name in ("DB_POOL_PRE_PING", "DB_PGBOUNCER"):
+        if not isinstance(config.get(name, False), bool):
+            raise ValueError(f"{name} must be True or False")
+    if settings["prewarm"] > settings["pool_size"]:
+        raise ValueError("DB_POOL_PREWARM cannot be larger than DB_POOL_SIZE")
+    if settings["pgbouncer"] and \
+            config.get("AUDIT_STREAM_BACKEND", "local") == "postgres":
+        # LISTEN needs a session of its own, which transaction pooling does
+        # not give
+        raise ValueError("the postgres audit stream backend does not work "
+                         "through PgBouncer")
+    return settings
+
+
+class DatabasePools:
+    """
+    Connection pool settings, prewarming and statistics for the server
+    databases, including every shard.
+
+    On servers other than SQLite each database gets a pool of DB_POOL_SIZE
+    connections, growing by up to DB_MAX_OVERFLOW under bursts, with
+    requests waiting at most DB_POOL_TIMEOUT seconds for one. Connections
+    are replaced after DB_POOL_RECYCLE seconds and tested before use with
+    DB_POOL_PRE_PING. Each worker opens DB_POOL_PREWARM connections per
+    database when it starts, after forking under uWSGI or on its first
+    request otherwise, including under uWSGI with lazy-apps.
+
+    DB_STATEMENT_TIMEOUT and DB_API_STATEMENT_TIMEOUT (milliseconds) cancel
+    statements on PostgreSQL that run longer, the latter in requests to the
+    client API so a slow query cannot hold the worker. Both are set per
+    transaction and only while handling a request, so CLI commands such as
+    upgradedb, import-keys or rebalance-app run without a limit. Setting
+    them per transaction also works through PgBouncer in transaction mode.
+    """
+
+    def __init__(self, app=None):
+        self.settings = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.settings = pool_settings(app.config)
+        app.extensions["pools"] = self
+
+        if not event.contains(Engine, "begin", _set_statement_timeout):
+            event.listen(Engine, "begin", _set_statement_timeout)
+
+        if self.settings["prewarm"]:
+            # with lazy-apps each worker loads the app after forking, so
+            # postfork hooks registered now would never run
+            if postfork is not None and not _lazy_apps():
+                postfork(lambda: self._prewarm_worker(app))
+            else:
+                app.before_first_request(self.prewarm)
+
+    def engine_options(self, sa_url, options: dict):
+        """Add the pool options to those of a new engine for `sa_url`."""
+        if sa_url.drivername.startswith("sqlite"):
+            return
+
+        settings = self.settings
+        options.update(poolclass=MonitoredPool,
+                       pool_size=settings["pool_size"],
+                       max_overflow=settings["max_overflow"],
+                       pool_timeout=settings["pool_timeout"],
+                       pool_recycle=settings["pool_recycle"],
+                       pool_pre_ping=settings["pool_pre_ping"])
+
+        if not sa_url.drivername.startswith("postgres"):
+            return
+        connect_args = options.setdefault("connect_args", {})
+        if settings["connect_timeout"]:
+            connect_args["connect_timeout"] = settings["connect_timeout"]
+
+    def _prewarm_worker(self, app):
+        with app.app_context():
+            for name in shards.names():
+                # pools copied from the parent process share its sockets
+                shards.engine(name).dispose()
+            self.prewarm()
+
+    def prewarm(self):
+        """Open DB_POOL_PREWARM connections to each database so the first
+        requests of a worker do not all connect at once."""
+        for name in shards.names():
+            engine = shards.engine(name)
+            if not isinstance(engine.pool, MonitoredPool):
+                continue
+            connections = []
+            try:
+                for _ in range(self.settings["prewarm"]):
+                    connections.append(engine.pool.connect())
+            except exc.SQLAlchemyError as error:
+                current_app.logger.warning(
+                    f"prewarming the {name} pool stopped after "
+                    f"{len(connections)} connection(s): {error}")
+            finally:
+                for connection in connections:
+                    connection.close()
+
+    def stats(self) -> dict:
+        """Statistics of this worker's pool for each database."""
+        stats = {}
+        for name in shards.names():
+            pool = shards.engine(name).pool
+            if isinstance(pool, MonitoredPool):
+                stats[name] = pool.stats()
+        return {"pid": os.getpid(), "pools": stats}
+
+
+def _lazy_apps() -> bool:
+    """Whether uWSGI loads the app in each worker rather than in the master
+    before forking."""
+    for name in ("lazy-apps", "lazy"):
+        value = uwsgi.opt.get(name)
+        if isinstance(value, bytes):
+            value = value.decode()
+        if value not in (None, False, "", "0", "false"):
+            return True
+    return False
+
+
+def _set_statement_timeout(connection):
+    # maintenance commands run outside requests and may take as long as
+    # they need
+    if connection.dialect.name != "postgresql" or not has_request_context() \
+            or "pools" not in current_app.extensions:
+        return
+
+    settings = current_app.extensions["pools"].settings
+    timeout = settings["statement_timeout"]
+    if request.endpoint in API_ENDPOINTS:
+        timeout = settings["api_statement_timeout"] or timeout
+    if timeout:
+        # sent on the DBAPI connection, where it opens the transaction
+        # that is beginning, so it lasts until that transaction ends
+        with connection.connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+pools = DatabasePools()
@@ -0,0 +1,197 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from hmac import compare_digest
+
+from flask import g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestProfile:
+    """
+    Profile of a single request.
+
+    In "cprofile" mode the request thread is traced with cProfile. In
+    "sample" mode a background thread records the request thread's stack
+    every `interval` seconds, producing collapsed stacks that flame graph
+    tools read directly. Either way every SQL statement is timed, and
+    samples taken while a statement runs end in a frame naming it.
+    """
+
+    def __init__(self, mode: str, interval: float):
+        self.mode = mode
+        self.interval = interval
+        self.statements = []
+        self.current_sql = None
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._profiler = None
+        self._sampler = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self._profiler:
+            self._profiler.disable()
+        if self._sampler:
+            self._stopped.set()
+            self._sampler.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+
+            sql = self.current_sql
+            if sql is not None:
+                stack.append(f"SQL {sql}")
+            self.stacks[";".join(stack)] += 1
+
+    def write(self, directory: str, name: str):
+        """Write the profile and SQL timings to `directory`, using `name` as
+        the prefix of the file names."""
+        base = os.path.join(directory, name)
+
+        if self._profiler:
+            self._profiler.dump_stats(base + ".pstats")
+        else:
+            with open(base + ".folded", "w") as folded:
+                for stack, count in self.stacks.items():
+                    folded.write(f"{stack} {count}\n")
+
+        with open(base + ".sql.txt", "w") as sql:
+            sql.write(f"request took {self.elapsed * 1000:.3f} ms, "
+                      f"{len(self.statements)} statement(s)\n")
+            for statement, duration in self.statements:
+                sql.write(f"{duration * 1000:10.3f} ms  {statement}\n")
+
+
+def _statement_name(statement: str) -> str:
+    return " ".join(statement.split())[:200]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    profile = has_request_context() and g.get("profile")
+    if profile:
+        profile.current_sql = _statement_name(statement)
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = has_request_context() and g.get("profile")
+    if profile and conn.info.get("profile_start"):
+        duration = time.perf_counter() - conn.info["profile_start"].pop()
+        profile.statements.append((_statement_name(statement), duration))
+        profile.current_sql = None
+
+
+def _rotate(directory: str, max_files: int):
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:max(0, len(paths) - max_files)]:
+        os.remove(path)
+
+
+def init_profiling(app):
+    """
+    Profile a PROFILE_SAMPLE_RATE fraction of requests, plus any request
+    carrying the PROFILE_HEADER header from a logged in user or with the
+    PROFILE_TOKEN value. Profiles are written per endpoint to PROFILE_DIR,
+    which keeps at most PROFILE_MAX_FILES files.
+    """
+    config = app.config
+    mode = config.get("PROFILE_MODE", "cprofile")
+    if mode not in ("cprofile", "sample"):
+        raise ValueError(f"unknown PROFILE_MODE {mode!r}")
+
+    directory = config.get("PROFILE_DIR", "profiles")
+    os.makedirs(directory, exist_ok=True)
+
+    if not event.contains(Engine, "before_cursor_execute",
+                          _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    def wanted() -> bool:
+        header = request.headers.get(config.get("PROFILE_HEADER",
+                                                "X-Keyserv-Profile"))
+        if header:
+            token = config.get("PROFILE_TOKEN")
+            # compared as bytes: compare_digest rejects non-ASCII strings
+            if token and compare_digest(header.encode(), token.encode()):
+                return True
+            if current_user.is_authenticated:
+                return True
+        return random.random() < config.get("PROFILE_SAMPLE_RATE", 0.0)
+
+    @app.before_request
+    def start_profile():
+        if wanted():
+            g.profile = RequestProfile(mode,
+                                       config.get("PROFILE_INTERVAL", 0.005))
+            g.profile.start()
+
+    @app.teardown_request
+    def stop_profile(exc):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+
+        profile.stop()
+        endpoint = re.sub(r"[^\w.-]", "_", request.endpoint or "unknown")
+        name = f"{endpoint}-{time.time():.6f}-{os.getpid()}"
+        try:
+            profile.write(directory, name)
+            _rotate(directory, config.get("PROFILE_MAX_FILES", 500))
+        except OSError as error:
+            app.logger.error(f"failed to write profile {name}: {error}")
@@ -0,0 +1,459 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import event, exc
+
+from keyserv.models import SHARDED_TABLES, Application, AuditLog, Key, db
+
+# name of the main database when used as a shard
+DEFAULT_SHARD = "default"
+# tables created on each shard besides the main database. applications are
+# copied to every shard so keys and logs can reference them
+SHARD_TABLES = ("application",) + SHARDED_TABLES + ("schema_version",)
+
+
+class ShardNotSelected(Exception):
+    """Raised when a sharded table is queried before a shard was chosen."""
+    pass
+
+
+class IdBlock(db.Model):
+    """Next free id of a sharded table. Ids are handed out from here so
+    they stay unique across shards and keys keep theirs when moved."""
+    name = db.Column(db.String, primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+
+class ShardAssignment(db.Model):
+    """Shard an application was moved to by rebalancing. Overrides
+    SHARD_MAP."""
+    app_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String, nullable=False)
+
+
+class ShardRouter:
+    """
+    Routes the key and audit_log tables of each application to one of
+    several databases.
+
+    SHARDS maps shard names to database URIs; the main database is also a
+    shard, named "default". SHARD_MAP maps application ids to shard names,
+    and applications that are not listed live in "default". Applications,
+    users and the other tables stay in the main database, with applications
+    copied to every shard so keys can reference them.
+
+    Without SHARDS everything stays in the main database and selecting a
+    shard does nothing, so callers do not need to check whether sharding is
+    enabled.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._assignments = {}
+        self._assignments_loaded = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["shards"] = self
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        for name, uri in app.config.get("SHARDS", {}).items():
+            if name == DEFAULT_SHARD:
+                raise ValueError(f"shard name {DEFAULT_SHARD!r} is reserved "
+                                 f"for the main database")
+            binds[f"shard:{name}"] = uri
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+    @property
+    def config(self):
+        return current_app.config
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("SHARDS"))
+
+    def names(self) -> list:
+        return [DEFAULT_SHARD] + list(self.config.get("SHARDS", {}))
+
+    def engine(self, name: str):
+        if name is None:
+            raise ShardNotSelected("select a shard before using the key or "
+                                   "audit_log tables")
+        if name == DEFAULT_SHARD:
+            return db.get_engine()
+        if name not in self.config.get("SHARDS", {}):
+            raise ValueError(f"unknown shard {name!r}")
+        return db.get_engine(bind=f"shard:{name}")
+
+    def _load_assignments(self) -> dict:
+        ttl = self.config.get("SHARD_MAP_TTL", 5)
+        with self._lock:
+            if time.monotonic() - self._assignments_loaded > ttl:
+                with db.get_engine().connect() as connection:
+                    self._assignments = dict(connection.execute(
+                        db.select([ShardAssignment.app_id,
+                                   ShardAssignment.shard])).fetchall())
+                self._assignments_loaded = time.monotonic()
+            return self._assignments
+
+    def shard_for_app(self, app_id: int) -> str:
+        if not self.enabled:
+            return DEFAULT_SHARD
+        shard = self._load_assignments().get(app_id)
+        if shard is None:
+            shard = self.config.get("SHARD_MAP", {}).get(
+                app_id, DEFAULT_SHARD)
+        return shard
+
+    def current(self) -> str:
+        return g.get("shard")
+
+    def select(self, name: str):
+        """Use shard `name` for the rest of the request."""
+        g.shard = name
+
+    def select_app(self, app_id: int):
+        """Use the shard of application `app_id` for the rest of the
+        request."""
+        self.select(self.shard_for_app(app_id))
+
+    @contextmanager
+    def use(self, name: str):
+        previous = self.current()
+        g.shard = name
+        try:
+            yield name
+        finally:
+            g.shard = previous
+
+    def each(self):
+        """Select each shard in turn, yielding its name."""
+        for name in self.names():
+            with self.use(name):
+                yield name
+
+    def find(self, func):
+        """Call `func` on each shard until it returns something other than
+        None, leave that shard selected and return the result."""
+        for name in self.names():
+            with self.use(name):
+                result = func()
+            if result is not None:
+                self.select(name)
+                return result
+        return None
+
+    def merge(self, func, key=None, reverse: bool = False,
+              limit: int = None):
+        """
+        Merge the rows `func` returns on every shard into one iterator.
+        `func` must return rows sorted by `key` (descending if `reverse`),
+        so only `limit` rows are ever needed from each shard.
+        """
+        results = []
+        for _ in self.each():
+            rows = func()
+            if limit is not None:
+                rows = rows.limit(limit)
+            results.append(rows.all())
+
+        merged = heapq.merge(*results, key=key, reverse=reverse)
+        if limit is None:
+            return merged
+        return (row for _, row in zip(range(limit), merged))
+
+    @property
+    def _single_writer(self) -> bool:
+        # SQLite allows one writer, which may already be the session, so ids
+        # are reserved in the session's transaction there and never cached
+        # beyond it
+        return db.get_engine().dialect.name == "sqlite"
+
+    def next_id(self, table: str) -> int:
+        """Return an id for a new row of `table`, unique across shards.
+        Ids are reserved from the main database SHARD_ID_BLOCK at a time."""
+        if self._single_writer:
+            return self.reserve_ids(table, 1)[0]
+
+        with self._lock:
+            start, end = self._blocks.get(table, (0, 0))
+            if start >= end:
+                start, end = self.reserve_ids(table, self.config.get(
+                    "SHARD_ID_BLOCK", 1000))
+            self._blocks[table] = (start + 1, end)
+            return start
+
+    def reserve_ids(self, table: str, count: int) -> tuple:
+        """Reserve `count` ids of `table` and return the (start, end) range,
+        end exclusive."""
+        if self._single_writer:
+            return self._reserve(db.session.connection(bind=db.get_engine()),
+                                 table, count)
+
+        for attempt in range(2):
+            try:
+                with db.get_engine().begin() as connection:
+                    return self._reserve(connection, table, count)
+            except exc.IntegrityError:
+                # another process created the row first
+                if attempt:
+                    raise
+
+    def _reserve(self, connection, table: str, count: int) -> tuple:
+        start = connection.execute(db.select([IdBlock.next_id])
+                                   .where(IdBlock.name == table)
+                                   .with_for_update()).scalar()
+        if start is None:
+            start = self._highest_id(table) + 1
+            connection.execute(IdBlock.__table__.insert().values(
+                name=table, next_id=start + count))
+        else:
+            connection.execute(IdBlock.__table__.update()
+                               .where(IdBlock.name == table)
+                               .values(next_id=start + count))
+        return start, start + count
+
+    def _highest_id(self, table: str) -> int:
+        column = db.metadata.tables[table].c.id
+        highest = 0
+        for name in self.names():
+            with self.engine(name).connect() as connection:
+                highest = max(highest, connection.execute(
+                    db.select([db.func.max(column)])).scalar() or 0)
+        return highest
+
+    def assign_ids(self, table: str, mappings: list) -> list:
+        """Give rows about to be bulk inserted into `table` their ids."""
+        if not self.enabled:
+            return mappings
+
+        missing = [mapping for mapping in mappings if "id" not in mapping]
+        if self._single_writer and missing:
+            start, _ = self.reserve_ids(table, len(missing))
+            for offset, mapping in enumerate(missing):
+                mapping["id"] = start + offset
+            return mappings
+
+        for mapping in missing:
+            mapping["id"] = self.next_id(table)
+        return mappings
+
+    def replicate_application(self, app: Application):
+        """Copy an application's row to every shard."""
+        if not self.enabled:
+            return
+        table = Application.__table__
+        row = {column.name: getattr(app, column.name)
+               for column in table.columns}
+        for name in self.names()[1:]:
+            with self.engine(name).begin() as connection:
+                updated = connection.execute(table.update()
+                                             .where(table.c.id == app.id)
+                                             .values(row)).rowcount
+                if not updated:
+                    connection.execute(table.insert().values(row))
+
+    def create_tables(self):
+        """Create SHARD_TABLES on every shard and copy the applications to
+        them."""
+        tables = [db.metadata.tables[name] for name in SHARD_TABLES]
+        for name in self.names()[1:]:
+            db.metadata.create_all(bind=self.engine(name), tables=tables)
+        for app in Application.query.all():
+            self.replicate_application(app)
+
+
+shards = ShardRouter()
+
+
+@event.listens_for(Key, "before_insert")
+@event.listens_for(AuditLog, "before_insert")
+def _assign_id(mapper, connection, target):
+    if target.id is None and shards.enabled:
+        target.id = shards.next_id(mapper.persist_selectable.name)
+
+
+def _copy_rows(table, source, target, where, batch_size: int,
+               log=print, merge=None) -> int:
+    """
+    Upsert the rows of `table` matching `where` from the `source` engine
+    into the `target` engine, `batch_size` rows per transaction. Rows the
+    target already has are updated in place, so rows referencing them keep
+    their foreign keys.
+
+    merge: - optional callable given a source row and the target's copy,
+             returning the values to give the target's copy, or None to
+             leave it. Rows the target has are overwritten without it
+    """
+    columns = [column.name for column in table.columns]
+    update = (table.update().where(table.c.id == db.bindparam("_id"))
+              .values({name: db.bindparam(f"_{name}") for name in columns
+                       if name != "id"}))
+    copied = 0
+    last_id = 0
+    while True:
+        with source.connect() as connection:
+            rows = connection.execute(
+                table.select().where(where).where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return copied
+
+        last_id = rows[-1].id
+        with target.begin() as connection:
+            existing = {row.id: row for row in connection.execute(
+                table.select().where(table.c.id.in_([row.id
+                                                     for row in rows])))}
+            inserts = [dict(row) for row in rows if row.id not in existing]
+            updates = []
+            for row in rows:
+                if row.id not in existing:
+                    continue
+                values = dict(row) if merge is None \
+                    else merge(row, existing[row.id])
+                if values is not None:
+                    updates.append({f"_{name}": values[name]
+                                    for name in columns})
+            if inserts:
+                connection.execute(table.insert(), inserts)
+            if updates:
+                connection.execute(update, updates)
+        copied += len(inserts) + len(updates)
+        log(f"  copied {copied} {table.name} row(s)")
+
+
+def _delete_rows(table, engine, where, batch_size: int):
+    while True:
+        with engine.begin() as connection:
+            ids = [row.id for row in connection.execute(
+                db.select([table.c.id]).where(where).limit(batch_size))]
+            if not ids:
+                return
+            connection.execute(table.delete().where(table.c.id.in_(ids)))
+
+
+def rebalance_app(app_id: int, target: str, batch_size: int = 5000,
+                  log=print):
+    """
+    Move an application's keys and audit logs to shard `target` while the
+    key server keeps serving it.
+
+    Rows are copied in batches while the source shard stays live, then the
+    rows changed during the copy are copied again. The application is then
+    pointed at the target and, once every worker's routing cache has
+    expired, changes made in the meantime are merged into the target before
+    the rows are deleted from the source. A key keeps the state of the copy
+    changed last, by updated_at, and the larger check and activation
+    counts of the two.
+    """
+    source = shards.shard_for_app(app_id)
+    if target not in shards.names():
+        raise ValueError(f"unknown shard {target!r}")
+    if source == target:
+        log(f"application {app_id} is already on {target}")
+        return
+
+    source_engine = shards.engine(source)
+    target_engine = shards.engine(target)
+    keys = Key.__table__
+    logs = AuditLog.__table__
+    # allow for clock differences between workers
+    margin = timedelta(minutes=1)
+
+    def now() -> tuple:
+        # key times are UTC, audit log times are local
+        return datetime.utcnow() - margin, datetime.now() - margin
+
+    def changed_since(since: tuple):
+        keys_since, logs_since = since
+        return (
+            (keys.c.app_id == app_id) & (
+                (keys.c.updated_at >= keys_since) |
+                (keys.c.last_check_ts >= keys_since) |
+                (keys.c.last_activation_ts >= keys_since)),
+            (logs.c.app_id == app_id) & (logs.c.last_seen >= logs_since))
+
+    def latest(*rows, column: str):
+        return max(rows, key=lambda row: row[column] or datetime.min)
+
+    def merge_key(row, existing):
+        # the key's state follows the copy with the latest tracked change,
+        # so a check served from the source cannot bring back what a key
+        # looked like before an activation on the target. Usage counters
+        # of both copies are merged, keeping the larger count
+        merged = dict(latest(existing, row, column="updated_at"))
+        for prefix, counter in (("last_check", "total_checks"),
+                                ("last_activation", "total_activations")):
+            used = latest(existing, row, column=f"{prefix}_ts")
+            merged[f"{prefix}_ts"] = used[f"{prefix}_ts"]
+            merged[f"{prefix}_ip"] = used[f"{prefix}_ip"]
+            merged[counter] = max(row[counter] or 0, existing[counter] or 0)
+        return merged if merged != dict(existing) else None
+
+    def merge_log(row, existing):
+        newer = latest(existing, row, column="last_seen")
+        return dict(row) if newer is not existing else None
+
+    log(f"copying application {app_id} from {source} to {target}")
+    started = now()
+    _copy_rows(keys, source_engine, target_engine, keys.c.app_id == app_id,
+               batch_size, log)
+    _copy_rows(logs, source_engine, target_engine, logs.c.app_id == app_id,
+               batch_size, log)
+
+    log("copying changes made during the copy")
+    since, started = started, now()
+    changed_keys, changed_logs = changed_since(since)
+    _copy_rows(keys, source_engine, target_engine, changed_keys, batch_size,
+               log)
+    _copy_rows(logs, source_engine, target_engine, changed_logs, batch_size,
+               log)
+
+    log(f"switching application {app_id} to {target}")
+    assignment = ShardAssignment.query.get(app_id)
+    if assignment is None:
+        db.session.add(ShardAssignment(app_id=app_id, shard=target))
+    else:
+        assignment.shard = target
+    db.session.commit()
+    time.sleep(current_app.config.get("SHARD_MAP_TTL", 5) + 2)
+
+    # the target has been written to since the switch, so rows changed on
+    # the source, by workers still routing there, are merged into it
+    log("copying changes made before the switch")
+    changed_keys, changed_logs = changed_since(started)
+    _copy_rows(keys, source_engine, target_engine, changed_keys, batch_size,
+               log, merge=merge_key)
+    _copy_rows(logs, source_engine, target_engine, changed_logs, batch_size,
+               log, merge=merge_log)
+
+    log(f"removing application {app_id} from {source}")
+    _delete_rows(logs, source_engine, logs.c.app_id == app_id, batch_size)
+    _delete_rows(keys, source_engine, keys.c.app_id == app_id, batch_size)
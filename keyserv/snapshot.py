@@ -0,0 +1,296 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from hmac import compare_digest
+
+from flask import current_app, request
+from flask_restful import abort
+
+from keyserv.models import Application, Key, db
+from keyserv.sharding import shards
+
+# the snapshot only holds what a check needs
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS key (id INTEGER PRIMARY KEY, "
+    "app_id INTEGER NOT NULL, token TEXT NOT NULL, enabled INTEGER NOT NULL, "
+    "hwid TEXT NOT NULL, remaining INTEGER, expires_at TEXT)",
+    "CREATE TABLE IF NOT EXISTS application (id INTEGER PRIMARY KEY, "
+    "support_message TEXT)",
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+)
+
+KEY_COLUMNS = (Key.id, Key.app_id, Key.token, Key.enabled, Key.hwid,
+               Key.remaining, Key.expires_at)
+
+# fixed width so expiry times compare correctly as text
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class DeltaTooLarge(Exception):
+    """Raised when more keys changed since a watermark than
+    SNAPSHOT_DELTA_LIMIT; the edge downloads a full snapshot instead."""
+    pass
+
+
+def format_time(value: datetime) -> str:
+    return value.strftime(TIME_FORMAT) if value is not None else None
+
+
+def parse_time(value: str) -> datetime:
+    return datetime.strptime(value, TIME_FORMAT)
+
+
+def has_snapshot_token() -> bool:
+    """Whether the request carries SNAPSHOT_TOKEN as a bearer token, i.e.
+    comes from an edge node. Always false while SNAPSHOT_TOKEN is unset."""
+    expected = current_app.config.get("SNAPSHOT_TOKEN")
+    given = request.headers.get("Authorization", "")
+    return bool(expected) and \
+        compare_digest(given.encode(), f"Bearer {expected}".encode())
+
+
+def require_snapshot_token(func):
+    """Only allow requests from edge nodes. The snapshot endpoints are
+    disabled while SNAPSHOT_TOKEN is unset."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not has_snapshot_token():
+            abort(404)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def _key_row(row) -> tuple:
+    return (row.id, row.app_id, row.token, bool(row.enabled), row.hwid or "",
+            row.remaining, format_time(row.expires_at))
+
+
+def _changed_keys(since: datetime = None, batch_size: int = 5000):
+    """Yield the snapshot rows of every key, or of the keys changed since
+    `since`, from every shard, `batch_size` keys per query. While an
+    application is being rebalanced its keys are on two shards; only the
+    copy on the shard it is assigned to is used."""
+    for shard in shards.each():
+        query = db.session.query(*KEY_COLUMNS)
+        if since is not None:
+            query = query.filter(Key.updated_at >= since)
+        last_id = 0
+        while True:
+            rows = (query.filter(Key.id > last_id).order_by(Key.id)
+                    .limit(batch_size).all())
+            if not rows:
+                break
+            last_id = rows[-1].id
+            yield from (_key_row(row) for row in rows
+                        if shards.shard_for_app(row.app_id) == shard)
+
+
+def _changed_apps(since: datetime = None) -> list:
+    query = db.session.query(Application.id, Application.support_message)
+    if since is not None:
+        query = query.filter(Application.updated_at >= since)
+    return [tuple(row) for row in query]
+
+
+def _count_changed(since: datetime) -> int:
+    return sum(db.session.query(Key.id).filter(Key.updated_at >= since)
+               .count() for _ in shards.each())
+
+
+def _overlap() -> timedelta:
+    # rows are stamped when flushed but only become visible on commit, and
+    # workers' clocks differ, so every delta re-reads a margin before the
+    # watermark
+    return timedelta(seconds=current_app.config.get("SNAPSHOT_OVERLAP", 60))
+
+
+def build_snapshot(path: str) -> datetime:
+    """
+    Write a snapshot of every key and application to the SQLite file
+    `path`, replacing it atomically, and return its watermark: the time the
+    snapshot is current as of.
+    """
+    watermark = datetime.utcnow()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    with sqlite3.connect(tmp) as connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        # the assignment may change while the shards are read
+        connection.executemany(
+            "INSERT OR REPLACE INTO key VALUES (?, ?, ?, ?, ?, ?, ?)",
+            _changed_keys())
+        connection.executemany("INSERT INTO application VALUES (?, ?)",
+                               _changed_apps())
+        connection.execute("INSERT INTO meta VALUES ('watermark', ?)",
+                           (format_time(watermark),))
+    connection.close()
+    os.replace(tmp, path)
+    return watermark
+
+
+_build_lock = threading.Lock()
+
+
+def cached_snapshot() -> str:
+    """Return the path of a full snapshot no older than SNAPSHOT_MAX_AGE
+    seconds, building one at SNAPSHOT_PATH if needed. Edges bring it up to
+    date with a delta afterwards, so it is also rebuilt once that delta
+    would be too large."""
+    path = current_app.config.get("SNAPSHOT_PATH", "snapshot.sqlite")
+    max_age = current_app.config.get("SNAPSHOT_MAX_AGE", 3600)
+    limit = current_app.config.get("SNAPSHOT_DELTA_LIMIT", 50000)
+    with _build_lock:
+        if not os.path.exists(path) or \
+                os.path.getmtime(path) < time.time() - max_age or \
+                _count_changed(Snapshot(path).watermark - _overlap()) > limit:
+            build_snapshot(path)
+    return os.path.abspath(path)
+
+
+def snapshot_delta(since: datetime) -> dict:
+    """
+    Return the keys and applications changed since the watermark `since`
+    and the watermark of the result. Raises DeltaTooLarge when more than
+    SNAPSHOT_DELTA_LIMIT keys changed.
+    """
+    watermark = datetime.utcnow()
+    since = since - _overlap()
+    limit = current_app.config.get("SNAPSHOT_DELTA_LIMIT", 50000)
+
+    changed = _count_changed(since)
+    if changed > limit:
+        raise DeltaTooLarge(f"{changed} keys changed since {since}")
+
+    return {"watermark": format_time(watermark),
+            "keys": list(_changed_keys(since)),
+            "apps": _changed_apps(since)}
+
+
+class Snapshot:
+    """
+    A snapshot file on an edge node. Each thread gets its own connection;
+    the file is in WAL mode so checks keep reading while it is refreshed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path) and self.watermark is not None
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    @property
+    def watermark(self) -> datetime:
+        row = self.connection().execute(
+            "SELECT value FROM meta WHERE name = 'watermark'").fetchone()
+        return parse_time(row[0]) if row else None
+
+    def replace(self, chunks):
+        """Replace the contents of the snapshot with a full one read from
+        `chunks` of bytes, in one transaction."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as snapshot:
+            for chunk in chunks:
+                snapshot.write(chunk)
+
+        # copied rather than moved over the file, which would leave its WAL
+        # to be replayed onto the new one
+        connection = self.connection()
+        connection.execute("ATTACH DATABASE ? AS full", (tmp,))
+        try:
+            with connection:
+                for table in ("key", "application", "meta"):
+                    connection.execute(f"DELETE FROM main.{table}")
+                    connection.execute(f"INSERT INTO main.{table} "
+                                       f"SELECT * FROM full.{table}")
+        finally:
+            connection.execute("DETACH DATABASE full")
+            os.remove(tmp)
+
+    def apply(self, delta: dict):
+        """Upsert the rows of a delta from the primary and advance the
+        watermark."""
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO key VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [tuple(row) for row in delta["keys"]])
+            connection.executemany(
+                "INSERT OR REPLACE INTO application VALUES (?, ?)",
+                [tuple(row) for row in delta["apps"]])
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('watermark', ?)",
+                (delta["watermark"],))
+
+    def keys_valid(self, app_id: int, checks: list) -> list:
+        """
+        Same comparison as keymanager.keys_valid_const, against the
+        snapshot. `checks` is a list of (token, hwid) pairs; returns the id
+        of the matching key for each, or None.
+        """
+        now = format_time(datetime.utcnow())
+        found = [None] * len(checks)
+        rows = self.connection().execute(
+            "SELECT id, app_id, token, enabled, hwid, expires_at FROM key")
+        for key_id, key_app, token, enabled, hwid, expires_at in rows:
+            for index, (check_token, check_hwid) in enumerate(checks):
+                if (compare_digest(check_token, token) and
+                        enabled and key_app == app_id
+                        and compare_digest(check_hwid, hwid)
+                        and (expires_at is None or expires_at > now)):
+                    found[index] = key_id
+        return found
+
+    def support_message(self, app_id: int) -> str:
+        row = self.connection().execute(
+            "SELECT support_message FROM application WHERE id = ?",
+            (app_id,)).fetchone()
+        return row[0] if row else None
+
+    def record_activation(self, app_id: int, token: str, hwid: str,
+                          remaining: int):
+        """Apply an activation the primary accepted, so checks pass before
+        the next refresh brings the key's new state."""
+        with self.connection() as connection:
+            connection.execute(
+                "UPDATE key SET hwid = ?, remaining = ? "
+                "WHERE app_id = ? AND token = ?",
+                (hwid, remaining, app_id, token))
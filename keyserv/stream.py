@@ -0,0 +1,239 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import event, text
+
+from keyserv.models import AuditLog, Event, RoutingSession, db
+from keyserv.sharding import shards
+
+BACKENDS = ("local", "postgres")
+
+
+def serialize_log(log: AuditLog) -> dict:
+    """JSON form of an audit log, as returned by /api/logs and streamed."""
+    return {
+        "id": log.id,
+        "key_id": log.key_id,
+        "app_id": log.app_id,
+        "event": log.event_type,
+        "timestamp": log.timestamp.isoformat(),
+        "last_seen": log.last_seen and log.last_seen.isoformat(),
+        "count": log.count,
+        "message": log.message,
+        "ip": log.origin_ip,
+        "machine": log.origin_machine,
+        "user": log.origin_user,
+        "hwid": log.origin_hwid,
+        "actor": log.actor}
+
+
+class Subscription:
+    """Queue of the audit events one stream client has not been sent yet."""
+
+    def __init__(self, app_id: int = None, key_id: int = None,
+                 event_type: int = None, size: int = 1000):
+        self.app_id = app_id
+        self.key_id = key_id
+        self.event_type = event_type
+        self.events = queue.Queue(size)
+        # events dropped because the client fell behind
+        self.dropped = 0
+
+    def matches(self, log: dict) -> bool:
+        return ((self.app_id is None or log["app_id"] == self.app_id) and
+                (self.key_id is None or log["key_id"] == self.key_id) and
+                (self.event_type is None or log["event"] == self.event_type))
+
+    def get(self, timeout: float):
+        """Return the next event, or None if there was none for `timeout`
+        seconds."""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AuditStream:
+    """
+    Fans new audit logs out to the clients of /logs/stream.
+
+    With the "local" backend logs are handed to the subscribers of the
+    worker that wrote them once their transaction commits, which is enough
+    for a single process. The "postgres" backend sends the id of each log
+    with NOTIFY in the transaction that writes it, and every worker LISTENs
+    on each database holding audit logs and loads the logs notified, so
+    subscribers see the logs written by all workers. Only ids are sent
+    because NOTIFY payloads are limited to 8000 bytes, which a long message
+    could exceed and abort the transaction writing it.
+    """
+
+    def __init__(self, app=None):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listeners = {}
+        self.backend = "local"
+        self.channel = "keyserv_audit"
+        self.queue_size = 1000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get("AUDIT_STREAM_BACKEND", "local")
+        if self.backend not in BACKENDS:
+            raise ValueError(f"unknown audit stream backend "
+                             f"{self.backend!r}")
+        self.channel = app.config.get("AUDIT_STREAM_CHANNEL", self.channel)
+        self.queue_size = app.config.get("AUDIT_STREAM_QUEUE", 1000)
+        app.extensions["audit_stream"] = self
+
+    @property
+    def active(self) -> bool:
+        """Whether new logs need to be sent anywhere. Always true with the
+        postgres backend, since other workers may have subscribers."""
+        return self.backend == "postgres" or bool(self._subscribers)
+
+    def subscribe(self, app_id: int = None, key_id: int = None,
+                  event_type: int = None) -> Subscription:
+        subscription = Subscription(app_id, key_id, event_type,
+                                    self.queue_size)
+        if self.backend == "postgres":
+            self._listen()
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stage(self, log_id: int, log: AuditLog = None):
+        """
+        Send the flushed log `log_id` to the subscribers once the session
+        commits. Does nothing unless the stream is active.
+
+        log: - the log itself if the caller has it loaded; otherwise the
+               local backend loads it, and the postgres one only sends the id
+        """
+        if not self.active:
+            return
+        if self.backend == "postgres":
+            # delivered by postgres when the transaction commits
+            db.session.connection(mapper=AuditLog.__mapper__).execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                channel=self.channel, payload=str(log_id))
+            return
+
+        if log is None:
+            log = AuditLog.query.populate_existing().get(log_id)
+        db.session().info.setdefault("audit_stream", []).append(
+            serialize_log(log))
+
+    def publish(self, log: dict):
+        """Hand a serialized log to every matching subscriber of this
+        worker. Subscribers whose queue is full miss it."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.matches(log):
+                try:
+                    subscription.events.put_nowait(log)
+                except queue.Full:
+                    subscription.dropped += 1
+
+    def _listen(self):
+        """Start a LISTEN thread for every postgres database holding audit
+        logs, unless one is already running."""
+        with self._lock:
+            for name in shards.names():
+                engine = shards.engine(name)
+                if engine.dialect.name != "postgresql" \
+                        or name in self._listeners:
+                    continue
+                thread = threading.Thread(target=self._listen_forever,
+                                          args=(engine,), daemon=True,
+                                          name=f"audit-stream-{name}")
+                self._listeners[name] = thread
+                thread.start()
+
+    def _listen_forever(self, engine):
+        while True:
+            try:
+                self._listen_once(engine)
+            except Exception:
+                # the database went away; reconnect after a pause
+                time.sleep(5)
+
+    def _listen_once(self, engine):
+        connection = engine.raw_connection()
+        try:
+            raw = connection.connection
+            raw.set_isolation_level(0)  # autocommit, LISTEN takes effect now
+            with raw.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+            while True:
+                if select.select([raw], [], [], 30) == ([], [], []):
+                    continue
+                raw.poll()
+                ids = set()
+                while raw.notifies:
+                    ids.add(int(raw.notifies.pop(0).payload))
+                for log in self._load(engine, ids):
+                    self.publish(serialize_log(log))
+        finally:
+            connection.invalidate()
+
+    @staticmethod
+    def _load(engine, ids: set) -> list:
+        """Read the notified logs that still exist, oldest first."""
+        if not ids:
+            return []
+        table = AuditLog.__table__
+        with engine.connect() as connection:
+            return connection.execute(table.select()
+                                      .where(table.c.id.in_(ids))
+                                      .order_by(table.c.id)).fetchall()
+
+
+audit_stream = AuditStream()
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish_staged(session):
+    for log in session.info.pop("audit_stream", ()):
+        audit_stream.publish(log)
+
+
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def _discard_staged(session, previous_transaction):
+    session.info.pop("audit_stream", None)
+
+
+def format_event(log: dict) -> str:
+    """Format a serialized log as a server-sent event."""
+    log = dict(log, event_name=Event(log["event"]).name)
+    return f"id: {log['id']}\nevent: log\ndata: {json.dumps(log)}\n\n"
@@ -20,16 +20,25 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import codecs
 import os
+from datetime import timezone
+from operator import attrgetter
 
 from flask import (Blueprint, abort, current_app, flash, redirect,
                    render_template, request, send_from_directory, url_for)
 from flask_login import current_user, login_required, login_user, logout_user
 
+from keyserv.audit import by_time, newest_first, newest_first_key
 from keyserv.auth import Users
-from keyserv.forms import AppForm, KeyForm, LoginForm
-from keyserv.keymanager import cut_key_unsafe
+from keyserv.caching import render_conditional
+from keyserv.forms import (AppForm, BulkKeyForm, ImportKeysForm, KeyForm,
+                           LoginForm)
+from keyserv.importer import import_keys
+from keyserv.keymanager import Origin, bulk_update_keys, cut_key_unsafe
 from keyserv.models import Application, AuditLog, Event, Key, db
+from keyserv.sharding import shards
+from keyserv.stream import audit_stream, format_event
 
 frontend = Blueprint("frontend", __name__)
 
@@ -65,29 +74,116 @@ def logout():
     return redirect(url_for("frontend.index"))
 
 
+def _keys_version(app_id: int = None) -> tuple:
+    query = db.session.query(db.func.max(Key.id), db.func.max(Key.updated_at))
+    if app_id is not None:
+        shards.select_app(app_id)
+        return tuple(query.filter(Key.app_id == app_id).one()) \
+            + _apps_version()
+    return tuple(value for _ in shards.each() for value in query.one()) \
+        + _apps_version()
+
+
+def _apps_version() -> tuple:
+    return tuple(db.session.query(db.func.count(Application.id),
+                                  db.func.max(Application.updated_at)).one())
+
+
+def _logs_version(**filters) -> tuple:
+    """Version of the logs on the selected shard matching `filters`, or of
+    every shard's logs if no filters are given."""
+    query = db.session.query(db.func.max(AuditLog.id),
+                             db.func.max(AuditLog.last_seen))
+    if filters:
+        rows = [query.filter_by(**filters).one()]
+    else:
+        rows = [query.one() for _ in shards.each()]
+    # audit log times are local, while Last-Modified is taken as UTC like
+    # the updated_at of keys and applications
+    return tuple(value for log_id, last_seen in rows for value in (
+        log_id, last_seen and last_seen.astimezone(timezone.utc)
+        .replace(tzinfo=None)))
+
+
+def _find_key(key_id: int) -> Key:
+    """Find a key on any shard and select that shard."""
+    return shards.find(lambda: Key.query.get(key_id))
+
+
 @frontend.route("/keys")
 @login_required
 def keys():
-    return render_template("keys.html", keys=Key.query.all())
+    return render_conditional(
+        "keys", _keys_version(),
+        lambda: render_template("keys.html", keys=list(shards.merge(
+            lambda: Key.query.order_by(Key.id), key=attrgetter("id")))))
 
 
 @frontend.route("/applications")
 @login_required
 def apps():
-    return render_template("applications.html", apps=Application.query.all())
+    def render():
+        key_counts = {}
+        for _ in shards.each():
+            key_counts.update(db.session.query(Key.app_id,
+                                               db.func.count(Key.id))
+                              .group_by(Key.app_id).all())
+        return render_template("applications.html",
+                               apps=Application.query.all(),
+                               key_counts=key_counts)
+
+    return render_conditional("apps", _apps_version() + _keys_version(),
+                              render)
 
 
 @frontend.route("/logs")
 @login_required
 def logs():
-    return render_template("logs.html", logs=AuditLog.query.all())
+    return render_conditional(
+        "logs", _logs_version() + _apps_version(),
+        lambda: render_template("logs.html", logs=list(shards.merge(
+            lambda: AuditLog.query.order_by(*newest_first(by_time())),
+            key=newest_first_key(by_time()), reverse=True)),
+            apps=Application.query.all(), events=list(Event)))
+
+
+@frontend.route("/logs/stream")
+@login_required
+def stream_logs():
+    """Server-sent events for audit logs as they are written, filtered by
+    the optional app_id, key_id and event query arguments."""
+    subscription = audit_stream.subscribe(
+        request.args.get("app_id", type=int),
+        request.args.get("key_id", type=int),
+        request.args.get("event", type=int))
+    keepalive = current_app.config.get("AUDIT_STREAM_KEEPALIVE", 15)
+    # the stream stays open far longer than a request needs its connection
+    db.session.remove()
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                log = subscription.get(keepalive)
+                if subscription.dropped:
+                    yield f"event: dropped\ndata: {subscription.dropped}\n\n"
+                    subscription.dropped = 0
+                # comments keep proxies from closing an idle stream and let
+                # the server notice clients that went away
+                yield ": keepalive\n\n" if log is None else format_event(log)
+        finally:
+            audit_stream.unsubscribe(subscription)
+
+    return current_app.response_class(
+        events(), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @frontend.route("/modify/key/<int:key_id>", methods=["GET", "POST"])
 @login_required
 def modify_key(key_id: int):
 
-    key = Key.query.get(key_id)
+    key = _find_key(key_id)
     if not key:
         abort(404)
 
@@ -118,10 +214,16 @@ def modify_key(key_id: int):
             changes.append(f"hwid changed from {key.hwid!r} to "
                            f"{form.hwid.data!r}")
             key.hwid = form.hwid.data
+        if key.expires_at != form.expires.data:
+            changes.append(f"expiry changed from {key.expires_at} to "
+                           f"{form.expires.data}")
+            key.expires_at = form.expires.data
 
         AuditLog.from_key(key, f"edited by {current_user.username} "
                           f"({request.remote_addr}):"
-                          f" {', '.join(changes)}", Event.KeyModified)
+                          f" {', '.join(changes)}", Event.KeyModified,
+                          Origin(request.remote_addr, None, None),
+                          current_user.username)
 
         try:
             db.session.commit()
@@ -135,6 +237,7 @@ def modify_key(key_id: int):
     form.memo.data = key.memo
     form.activations.data = key.remaining
     form.hwid.data = key.hwid
+    form.expires.data = key.expires_at
 
     return render_template("add_modify.html",
                            header=f"Modify Key {key.id}", form=form)
@@ -155,7 +258,8 @@ def add_key(app_id=None):
         try:
             token = cut_key_unsafe(form.activations.data,
                                    form.application.data,
-                                   form.active.data, form.memo.data)
+                                   form.active.data, form.memo.data,
+                                   form.expires.data)
             flash(f"Key added! Token: {token}", "success")
         except Exception as error:
             flash(f"Unable to add key: {error}", "error")
@@ -163,6 +267,35 @@ def add_key(app_id=None):
     return render_template("add_modify.html", header="Add Key", form=form)
 
 
+@frontend.route("/import/keys", methods=["GET", "POST"])
+@login_required
+def import_keys_view():
+    form = ImportKeysForm()
+    form.application.choices = [(0, "None")] + [
+        (app.id, app.name) for app in Application.query.all()]
+
+    if request.method == "POST" and form.validate_on_submit():
+        if not form.keys_file.data:
+            flash("Choose a file to import.", "error")
+        else:
+            try:
+                result = import_keys(
+                    codecs.iterdecode(form.keys_file.data.stream, "utf-8"),
+                    form.format.data, form.application.data or None,
+                    form.duplicates.data,
+                    current_app.config.get("IMPORT_BATCH_SIZE", 5000),
+                    skip_invalid=form.skip_invalid.data,
+                    actor=current_user.username)
+                flash(f"Import finished: {result}", "success")
+                return redirect(url_for("frontend.keys"))
+            except Exception as error:
+                db.session.rollback()
+                flash(f"Import failed: {error}", "error")
+
+    return render_template("add_modify.html", header="Import Keys",
+                           form=form)
+
+
 @frontend.route("/add/app", methods=["GET", "POST"])
 @login_required
 def add_app():
@@ -176,6 +309,7 @@ def add_app():
         db.session.add(app)
         try:
             db.session.commit()
+            shards.replicate_application(app)
             flash("Success!")
         except Exception as error:
             flash(f"Failed to add application: {error}")
@@ -199,6 +333,7 @@ def modify_app(app_id: int):
         app.support_message = form.support.data
         try:
             db.session.commit()
+            shards.replicate_application(app)
             flash("Success.")
             return redirect(url_for("frontend.detail_app", app_id=app.id))
         except Exception as error:
@@ -214,12 +349,16 @@ def modify_app(app_id: int):
 @login_required
 def detail_key(key_id: int):
 
-    key = Key.query.get(key_id)
+    key = _find_key(key_id)
 
     if not key:
         abort(404)
 
-    return render_template("detail_key.html", key=key)
+    version = (key.updated_at, key.total_checks, key.last_check_ts,
+               key.app.updated_at) + _logs_version(key_id=key.id)
+    return render_conditional(
+        f"key-{key.id}", version,
+        lambda: render_template("detail_key.html", key=key))
 
 
 @frontend.route("/detail/app/<int:app_id>")
@@ -231,7 +370,12 @@ def detail_app(app_id: int):
     if not app:
         abort(404)
 
-    return render_template("detail_app.html", app=app)
+    shards.select_app(app.id)
+    version = (app.updated_at, Key.query.filter_by(app_id=app.id).count()) \
+        + _logs_version(app_id=app.id)
+    return render_conditional(
+        f"app-{app.id}", version,
+        lambda: render_template("detail_app.html", app=app))
 
 
 @frontend.route("/keys/app/<int:app_id>")
@@ -243,14 +387,51 @@ def keys_for_app(app_id):
     if not app:
         abort(404)
 
-    return render_template("keys.html", keys=app.keys)
+    # selects the application's shard for app.keys
+    return render_conditional(
+        f"keys-{app.id}", _keys_version(app.id),
+        lambda: render_template("keys.html", keys=app.keys))
+
+
+@frontend.route("/keys/bulk", methods=["GET", "POST"])
+@login_required
+def bulk_keys():
+    form = BulkKeyForm()
+    form.application.choices = [(0, "Any Application")] + [
+        (app.id, app.name) for app in Application.query.all()]
+
+    if request.method == "POST" and form.validate_on_submit():
+        tokens = None
+        if form.tokens_file.data:
+            tokens = (line.decode("utf-8")
+                      for line in form.tokens_file.data.stream)
+        elif form.tokens.data.strip():
+            tokens = form.tokens.data.splitlines()
+
+        try:
+            updated = bulk_update_keys(
+                form.action.data, form.value.data or None,
+                app_id=form.application.data or None,
+                enabled={"yes": True, "no": False}.get(form.enabled.data),
+                memo=form.memo.data or None, tokens=tokens,
+                origin=Origin(request.remote_addr, None, None),
+                actor=current_user.username,
+                chunk_size=current_app.config.get("BULK_CHUNK_SIZE", 1000),
+                all_keys=form.all_keys.data)
+            flash(f"Updated {updated} key(s).", "success")
+            return redirect(url_for("frontend.keys"))
+        except Exception as error:
+            flash(f"Bulk update failed: {error}", "error")
+
+    return render_template("add_modify.html", header="Bulk Edit Keys",
+                           form=form)
 
 
 @frontend.route("/keys/deactivate/<int:key_id>")
 @login_required
 def disable_key(key_id):
 
-    key = Key.query.get(key_id)
+    key = _find_key(key_id)
 
     if not key:
         abort(404)
@@ -265,7 +446,7 @@ def disable_key(key_id):
 @login_required
 def enable_key(key_id):
 
-    key = Key.query.get(key_id)
+    key = _find_key(key_id)
 
     if not key:
         abort(404)
@@ -2,7 +2,9 @@ import os
 
 from keyserv import create_app
 
-if os.environ.get("FLASK_DEBUG"):
+if os.environ.get("KEYSERV_CONFIG"):
+    app = create_app(os.environ["KEYSERV_CONFIG"])
+elif os.environ.get("FLASK_DEBUG"):
     app = create_app("DevelopmentConfig")
 else:
     app = create_app("ProductionConfig")
@@ -0,0 +1,40 @@
+import threading
+from contextlib import contextmanager
+
+from werkzeug.serving import make_server
+
+from keyserv import create_app
+from keyserv.models import Application, Key, db
+
+
+def make_app(database: str, **settings):
+    """Create an app with a test config, its tables, application 1 and a
+    key for each (token, remaining activations) in `settings["KEYS"]`."""
+    keys = settings.pop("KEYS", ())
+    config = type("TestConfig", (), dict(
+        SECRET_KEY="test", SQLALCHEMY_DATABASE_URI=f"sqlite:///{database}",
+        SQLALCHEMY_TRACK_MODIFICATIONS=False, WTF_CSRF_ENABLED=False,
+        **settings))
+    app = create_app(config)
+    if keys:
+        with app.app_context():
+            db.create_all()
+            db.session.add(Application(name="test"))
+            db.session.commit()
+            for token, remaining in keys:
+                db.session.add(Key(token, remaining, 1))
+            db.session.commit()
+    return app
+
+
+@contextmanager
+def serve(wsgi_app):
+    """Serve `wsgi_app` on a local port for the duration of the block,
+    yielding its URL."""
+    server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
@@ -0,0 +1,130 @@
+"""Runs keyserv.client against the key server on a local werkzeug server."""
+
+import time
+from datetime import timedelta
+
+import pytest
+
+from helpers import make_app, serve
+from keyserv.client import KeyServerClient, KeyServerError, Unavailable
+from keyserv.models import Key
+
+TOKENS = [f"TOKEN{number}" for number in range(5)]
+
+
+class Faults:
+    """WSGI middleware answering the next requests with canned errors
+    before passing requests on to the app."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = []
+        self.paths = []
+
+    def fail(self, status: str, count: int = 1, headers: list = ()):
+        self.pending += [(status, list(headers))] * count
+
+    def __call__(self, environ, start_response):
+        self.paths.append(environ["PATH_INFO"])
+        if self.pending:
+            status, headers = self.pending.pop(0)
+            start_response(status, headers)
+            return [b""]
+        return self.app(environ, start_response)
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    app = make_app(tmp_path_factory.mktemp("db") / "keyserver.db",
+                   CHECK_BATCH_LIMIT=3,
+                   KEYS=[(token, -1) for token in TOKENS] + [("LIMITED", 1)])
+    faults = Faults(app.wsgi_app)
+    with serve(faults) as url:
+        faults.url = url
+        faults.flask_app = app
+        yield faults
+
+
+@pytest.fixture
+def faults(server):
+    server.pending.clear()
+    server.paths.clear()
+    return server
+
+
+def make_client(faults, tmp_path, **kwargs):
+    options = dict(app_id=1, hwid="", machine="machine", user="user",
+                   cache_path=str(tmp_path / "cache.json"), backoff=0.01,
+                   max_backoff=2)
+    options.update(kwargs)
+    return KeyServerClient(faults.url, **options)
+
+
+def test_check(faults, tmp_path):
+    with make_client(faults, tmp_path) as client:
+        assert client.check(TOKENS[0])
+        assert not client.check("UNKNOWN")
+
+
+def test_check_many_batches(faults, tmp_path):
+    with make_client(faults, tmp_path, batch_size=2) as client:
+        results = client.check_many(TOKENS + ["UNKNOWN"])
+
+    assert [result.valid for result in results] == [True] * 5 + [False]
+    assert faults.paths.count("/api/check/batch") == 3
+
+
+def test_check_many_rejected_batch(faults, tmp_path):
+    with make_client(faults, tmp_path, batch_size=2) as client:
+        client.check_many(TOKENS[:4])
+    # larger than CHECK_BATCH_LIMIT; must not be answered from the cache
+    with make_client(faults, tmp_path, batch_size=5) as client:
+        with pytest.raises(KeyServerError) as error:
+            client.check_many(TOKENS[:4])
+    assert not isinstance(error.value, Unavailable)
+
+
+def test_backoff_honors_retry_after(faults, tmp_path):
+    faults.fail("429 Too Many Requests", headers=[("Retry-After", "1")])
+    faults.fail("503 Service Unavailable")
+    with make_client(faults, tmp_path) as client:
+        started = time.monotonic()
+        result = client.check(TOKENS[1])
+
+    assert result and not result.offline
+    assert time.monotonic() - started >= 1
+    assert faults.paths.count("/api/check") == 3
+
+
+def test_offline_grace(faults, tmp_path):
+    with make_client(faults, tmp_path, max_retries=1) as client:
+        assert client.check(TOKENS[2])
+
+        faults.fail("503 Service Unavailable", count=2)
+        result = client.check(TOKENS[2])
+        assert result and result.offline
+
+        faults.fail("503 Service Unavailable", count=2)
+        with pytest.raises(Unavailable):
+            client.check(TOKENS[3])
+
+    with make_client(faults, tmp_path, max_retries=1,
+                     grace_period=timedelta(0)) as client:
+        faults.fail("503 Service Unavailable", count=2)
+        with pytest.raises(Unavailable):
+            client.check(TOKENS[2])
+
+
+def test_activation_not_resent_after_gateway_error(faults, tmp_path):
+    with make_client(faults, tmp_path) as client:
+        faults.fail("504 Gateway Timeout")
+        with pytest.raises(Unavailable):
+            client.activate("LIMITED")
+        assert faults.paths == ["/api/activate"]
+
+        faults.fail("503 Service Unavailable")
+        assert client.activate("LIMITED") == 0
+        assert faults.paths.count("/api/activate") == 3
+
+    with faults.flask_app.app_context():
+        assert Key.query.filter_by(token="LIMITED").one().remaining == 0
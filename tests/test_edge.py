@@ -0,0 +1,109 @@
+"""Runs an edge node against a primary key server, both in this process."""
+
+import threading
+
+import pytest
+
+from helpers import make_app, serve
+from keyserv.edge import edge
+from keyserv.models import AuditLog, Event, Key, db
+
+TOKEN = "EDGETOKEN"
+CHECK = {"token": TOKEN, "app_id": 1, "hwid": "", "machine": "machine",
+         "user": "user"}
+
+
+@pytest.fixture
+def primary(tmp_path):
+    app = make_app(tmp_path / "primary.db", SNAPSHOT_TOKEN="secret",
+                   SNAPSHOT_PATH=str(tmp_path / "snapshot.sqlite"),
+                   KEYS=[(TOKEN, 2), ("OTHER", -1)])
+    with serve(app) as url:
+        app.url = url
+        yield app
+
+
+def make_edge(primary, tmp_path, name: str = "edge"):
+    return make_app(tmp_path / f"{name}.db", SNAPSHOT_TOKEN="secret",
+                    EDGE_PRIMARY_URL=primary.url,
+                    EDGE_SNAPSHOT_PATH=str(tmp_path / f"{name}.sqlite"),
+                    EDGE_REFRESH_INTERVAL=3600)
+
+
+def key(app, token: str = TOKEN) -> Key:
+    with app.app_context():
+        return Key.query.filter_by(token=token).one()
+
+
+def test_checks_answered_and_reported(primary, tmp_path):
+    edge_app = make_edge(primary, tmp_path)
+    client = edge_app.test_client()
+
+    assert client.get("/api/check", query_string=CHECK).status_code == 201
+    assert client.get("/api/check", query_string=dict(
+        CHECK, token="UNKNOWN")).status_code == 404
+    assert client.get("/keys").status_code == 404
+
+    with edge_app.app_context():
+        assert edge.enabled
+        edge.node.refresh()
+    assert key(primary).total_checks == 1
+
+
+def test_changes_reach_edge_on_refresh(primary, tmp_path):
+    edge_app = make_edge(primary, tmp_path)
+    client = edge_app.test_client()
+    assert client.get("/api/check", query_string=CHECK).status_code == 201
+
+    with primary.app_context():
+        Key.query.filter_by(token=TOKEN).one().enabled = False
+        db.session.commit()
+    with edge_app.app_context():
+        edge.node.refresh()
+
+    assert client.get("/api/check", query_string=CHECK).status_code == 404
+
+
+def test_activation_forwarded_with_client_ip(primary, tmp_path):
+    edge_app = make_edge(primary, tmp_path)
+    client = edge_app.test_client()
+
+    response = client.post("/api/activate", data=dict(CHECK, hwid="HW"),
+                           environ_base={"REMOTE_ADDR": "10.1.2.3"})
+    assert response.status_code == 201
+    assert response.get_json()["remainingActivations"] == "1"
+    assert key(primary).last_activation_ip == "10.1.2.3"
+    with primary.app_context():
+        assert AuditLog.query.filter_by(
+            event_type=int(Event.AppActivation)).one().origin_ip == "10.1.2.3"
+
+    # answered from the snapshot before the next refresh
+    assert client.get("/api/check", query_string=dict(
+        CHECK, hwid="HW")).status_code == 201
+
+
+def test_primary_ignores_unauthenticated_origin_ip(primary, tmp_path):
+    make_edge(primary, tmp_path)
+    # the primary in the same process still handles activations itself
+    response = primary.test_client().post(
+        "/api/activate", data=dict(CHECK, token="OTHER", origin_ip="6.6.6.6"))
+    assert response.status_code == 201
+    with primary.app_context():
+        assert AuditLog.query.filter_by(
+            event_type=int(Event.AppActivation)).one().origin_ip == "127.0.0.1"
+
+
+def test_concurrent_cold_start(primary, tmp_path):
+    edge_app = make_edge(primary, tmp_path, "cold")
+    statuses = []
+
+    def check():
+        statuses.append(edge_app.test_client().get(
+            "/api/check", query_string=CHECK).status_code)
+
+    threads = [threading.Thread(target=check) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [201] * 8
@@ -0,0 +1,14 @@
+"""Fails when a hot query's plan reads a whole table instead of an index."""
+
+from helpers import make_app
+from keyserv.plancheck import check_plans
+from keyserv.sharding import shards
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    app = make_app(tmp_path / "plans.db", KEYS=[("TOKEN", 1)])
+    failures = []
+    with app.app_context():
+        for _ in shards.each():
+            assert check_plans(2000, log=failures.append), "\n".join(
+                line for line in failures if line.startswith("FAIL"))